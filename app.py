@@ -1,60 +1,119 @@
 import os
 
+import click
 from flask import Flask
-from sqlalchemy import inspect, text
 
+from conditional import init_static_fingerprints
+from engine import engine_options
 from extensions import db
+from jobs import handlers, init_jobs
+from migrations import init_migrations
 from models import Tip, User
-from routes import main
-
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.getenv("SECRET_KEY", "dev-secret-key")
+from profiling import init_profiling
+from routes import api, main
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-db_url = os.getenv("DATABASE_URL")
 
-if db_url:
+def normalize_url(db_url):
     # normalize Render old scheme
     db_url = db_url.replace("postgres://", "postgresql://", 1)
 
     # force psycopg (v3) driver so SQLAlchemy won't try psycopg2
     if db_url.startswith("postgresql://"):
         db_url = "postgresql+psycopg://" + db_url[len("postgresql://"):]
+    return db_url
+
+
+def database_url():
+    db_url = os.getenv("DATABASE_URL")
+
+    if db_url:
+        return normalize_url(db_url)
 
-    app.config["SQLALCHEMY_DATABASE_URI"] = db_url
-    USING_POSTGRES = True
-else:
     instance_dir = os.path.join(basedir, "instance")
     os.makedirs(instance_dir, exist_ok=True)
+    return "sqlite:///" + os.path.join(instance_dir, "app.db")
+
 
-    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(instance_dir, "app.db")
-    USING_POSTGRES = False
+def create_app(config=None):
+    """Build the application without touching the database.
 
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    The schema is upgraded by ``flask migrate`` and seed data added by
+    ``flask init-db``; requests only check the schema version.
+    """
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.getenv("SECRET_KEY", "dev-secret-key")
 
-db.init_app(app)
-print("USING DATABASE:", app.config["SQLALCHEMY_DATABASE_URI"])
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url()
+    if config:
+        app.config.update(config)
+    app.config["USING_POSTGRES"] = app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgresql")
 
-app.register_blueprint(main)
-print("URL map:")
-for rule in app.url_map.iter_rules():
-    print(rule.endpoint, "->", rule)
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    replica_url = os.getenv("DATABASE_REPLICA_URL")
+    if replica_url:
+        app.config.setdefault("SQLALCHEMY_BINDS", {}).setdefault("replica", normalize_url(replica_url))
+    app.config.setdefault("REPLICA_STICKY_SECONDS", int(os.getenv("REPLICA_STICKY_SECONDS", "10")))
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config["USING_POSTGRES"]))
+    app.config.setdefault("PASSWORD_HASH_METHOD", os.getenv("PASSWORD_HASH_METHOD", "pbkdf2:sha256:600000"))
+    app.config.setdefault("PASSWORD_HASH_WORKERS", int(os.getenv("PASSWORD_HASH_WORKERS", "2")))
+    app.config.setdefault("CURRENT_USER_CACHE_TTL", int(os.getenv("CURRENT_USER_CACHE_TTL", "60")))
+    app.config.setdefault("FRAGMENT_CACHE_TTL", int(os.getenv("FRAGMENT_CACHE_TTL", "300")))
+    strict_loading = os.getenv("STRICT_LOADING", "").lower() in ("1", "true", "yes", "on")
+    app.config.setdefault("STRICT_LOADING", strict_loading or app.config.get("TESTING", False))
+    app.config.setdefault("PROFILING", os.getenv("PROFILING", "").lower() in ("1", "true", "yes", "on"))
+    app.config.setdefault("METRICS_TOKEN", os.getenv("METRICS_TOKEN"))
+    app.config.setdefault("N_PLUS_ONE_THRESHOLD", int(os.getenv("N_PLUS_ONE_THRESHOLD", "5")))
+    app.config.setdefault("PROFILE_ENDPOINT", os.getenv("PROFILE_ENDPOINT"))
+    app.config.setdefault("PROFILE_SAMPLE_RATE", float(os.getenv("PROFILE_SAMPLE_RATE", "0.01")))
+    app.config.setdefault("PROFILE_DIR", os.getenv("PROFILE_DIR", os.path.join(basedir, "instance", "profiles")))
+    app.config.setdefault("JOB_MAX_ATTEMPTS", int(os.getenv("JOB_MAX_ATTEMPTS", "5")))
+    app.config.setdefault("JOB_VISIBILITY_TIMEOUT", int(os.getenv("JOB_VISIBILITY_TIMEOUT", "300")))
+    app.config.setdefault("JOB_RETRY_DELAY", int(os.getenv("JOB_RETRY_DELAY", "30")))
+    app.config.setdefault("JOB_POLL_INTERVAL", float(os.getenv("JOB_POLL_INTERVAL", "1")))
+    app.config.setdefault("JOB_RETENTION_DAYS", int(os.getenv("JOB_RETENTION_DAYS", "7")))
+    app.config.setdefault("JOB_WORKER_THREAD", os.getenv("JOB_WORKER_THREAD", "").lower() in ("1", "true", "yes", "on"))
+    app.config.setdefault("SYNC_RETENTION_DAYS", int(os.getenv("SYNC_RETENTION_DAYS", "30")))
+    app.config.setdefault("IMPORT_RETENTION_DAYS", int(os.getenv("IMPORT_RETENTION_DAYS", "90")))
+    app.config.setdefault("ROLLUP_REOPEN_DAYS", int(os.getenv("ROLLUP_REOPEN_DAYS", "3")))
+    app.config.setdefault("MIGRATION_BATCH_SIZE", int(os.getenv("MIGRATION_BATCH_SIZE", "1000")))
+    app.config.setdefault("MIGRATION_LOCK_TIMEOUT_MS", int(os.getenv("MIGRATION_LOCK_TIMEOUT_MS", "5000")))
+    app.config.setdefault("EXPORT_DIR", os.getenv("EXPORT_DIR", os.path.join(basedir, "instance", "exports")))
 
+    db.init_app(app)
+    app.register_blueprint(main)
+    app.register_blueprint(api)
+    register_aliases(app)
+    register_commands(app)
+    init_static_fingerprints(app)
+    init_profiling(app)
+    init_jobs(app)
+    init_migrations(app)
+    return app
 
-def ensure_schema():
-    inspector = inspect(db.engine)
-    user_columns = {col["name"] for col in inspector.get_columns("users")} if inspector.has_table("users") else set()
 
-    if "is_admin" not in user_columns:
-        db.session.execute(text("ALTER TABLE users ADD COLUMN is_admin BOOLEAN NOT NULL DEFAULT 0"))
-    if "created_at" not in user_columns:
-        db.session.execute(text("ALTER TABLE users ADD COLUMN created_at DATETIME"))
+def register_aliases(app):
+    vf = app.view_functions
 
-    if not inspector.has_table("tips"):
-        Tip.__table__.create(db.engine)
+    def _add_alias(rule, endpoint, blueprint_view_name, methods=None):
+        view = vf.get(blueprint_view_name)
+        if view and endpoint not in vf:
+            if methods:
+                app.add_url_rule(rule, endpoint=endpoint, view_func=view, methods=methods)
+            else:
+                app.add_url_rule(rule, endpoint=endpoint, view_func=view)
 
-    db.session.commit()
+    _add_alias('/', 'home', 'main.home')
+    _add_alias('/tracker', 'tracker', 'main.tracker')
+    _add_alias('/mood', 'mood', 'main.mood', methods=['GET', 'POST'])
+    _add_alias('/habit', 'habit', 'main.habit', methods=['GET', 'POST'])
+    _add_alias('/todo', 'todo', 'main.todo', methods=['GET', 'POST'])
+    _add_alias('/tips', 'tips', 'main.tips')
+    _add_alias('/tip/<int:tip_id>', 'tip', 'main.tip_detail')
+    _add_alias('/badges', 'badges', 'main.badges')
+    _add_alias('/signup', 'signup', 'main.signup', methods=['GET', 'POST'])
+    _add_alias('/login', 'login', 'main.login', methods=['GET', 'POST'])
 
 
 def ensure_seed_data():
@@ -88,32 +147,210 @@ def ensure_seed_data():
         db.session.commit()
 
 
-with app.app_context():
-    vf = app.view_functions
+def init_db(progress=None):
+    from migrations import migrate
 
-    def _add_alias(rule, endpoint, blueprint_view_name, methods=None):
-        view = vf.get(blueprint_view_name)
-        if view and endpoint not in vf:
-            if methods:
-                app.add_url_rule(rule, endpoint=endpoint, view_func=view, methods=methods)
-            else:
-                app.add_url_rule(rule, endpoint=endpoint, view_func=view)
+    migrate(progress)
+    ensure_seed_data()
 
-    _add_alias('/', 'home', 'main.home')
-    _add_alias('/tracker', 'tracker', 'main.tracker')
-    _add_alias('/mood', 'mood', 'main.mood', methods=['GET', 'POST'])
-    _add_alias('/habit', 'habit', 'main.habit', methods=['GET', 'POST'])
-    _add_alias('/todo', 'todo', 'main.todo', methods=['GET', 'POST'])
-    _add_alias('/tips', 'tips', 'main.tips')
-    _add_alias('/tip/<int:tip_id>', 'tip', 'main.tip_detail')
-    _add_alias('/badges', 'badges', 'main.badges')
-    _add_alias('/signup', 'signup', 'main.signup', methods=['GET', 'POST'])
-    _add_alias('/login', 'login', 'main.login', methods=['GET', 'POST'])
 
-    db.create_all()
-    if not USING_POSTGRES:
-        ensure_schema()
-    ensure_seed_data()
+def register_commands(app):
+    @app.cli.command("init-db")
+    def init_db_command():
+        """Apply pending migrations and seed data."""
+        init_db(progress=_echo_migration)
+        click.echo("Database initialised.")
+
+    @app.cli.command("migrate")
+    def migrate_command():
+        """Apply pending schema migrations; run once per deploy, before the new code serves."""
+        from migrations import head_version, migrate
+
+        applied = migrate(progress=_echo_migration)
+        click.echo(f"Applied {len(applied)} migration(s); schema is at version {head_version()}.")
+
+    @app.cli.command("migrations")
+    def migrations_command():
+        """List the schema migrations and when each was applied."""
+        from migrations import applied_versions, migrations
+
+        applied = applied_versions()
+        for step in migrations:
+            status = applied[step.version].strftime("%Y-%m-%d %H:%M") if step.version in applied else "pending"
+            click.echo(f"{step.version:>4}  {step.name:<28} {status}")
+
+    @app.cli.command("sync-replica")
+    def sync_replica_command():
+        """Copy the SQLite database onto the SQLite DATABASE_REPLICA_URL, for trying replica reads locally."""
+        from replica import REPLICA_BIND, sync_sqlite_replica
+
+        if REPLICA_BIND not in db.engines:
+            raise click.ClickException("DATABASE_REPLICA_URL is not set.")
+        try:
+            sync_sqlite_replica(db.engines[None], db.engines[REPLICA_BIND])
+        except ValueError as error:
+            raise click.ClickException(str(error))
+        click.echo("Replica refreshed from the primary.")
+
+    @app.cli.command("rebuild-stats")
+    @click.option("--check", is_flag=True, help="Only report drift, do not rewrite user_stats.")
+    def rebuild_stats_command(check):
+        """Recount user_stats from the raw tables and report any drift."""
+        from stats import rebuild_user_stats
+
+        drift = rebuild_user_stats(fix=not check)
+        for user_id, stored, actual in drift:
+            click.echo(f"user {user_id}: stored={stored} actual={actual}")
+        verb = "Found" if check else "Fixed"
+        click.echo(f"{verb} {len(drift)} drifted user_stats row(s).")
+
+    @app.cli.command("award-badges")
+    def award_badges_command():
+        """Evaluate every badge for every user and store new unlocks."""
+        from badges import sync_badges
+
+        unlocked = sync_badges()
+        db.session.commit()
+        click.echo(f"Unlocked {len(unlocked)} new badge(s).")
+
+    @app.cli.command("reindex-tips")
+    def reindex_tips_command():
+        """Rebuild the full-text search index over tips."""
+        from search import ensure_search_index, rebuild_search_index
+
+        if not ensure_search_index():
+            raise click.ClickException("This SQLite build has no FTS5; search uses LIKE scans.")
+        rebuild_search_index()
+        click.echo("Tip search index rebuilt.")
+
+    @app.cli.command("export")
+    @click.argument("resource", type=_LazyChoice(_export_resources))
+    @click.option("--format", "fmt", type=_LazyChoice(_export_formats), default="csv", show_default=True)
+    @click.option("--user-id", type=int, help="Only this user's rows.")
+    @click.option("--gzip", "compress", is_flag=True, help="Compress the output with gzip.")
+    @click.option("-o", "--output", type=click.File("wb"), default="-", help="File to write (default: stdout).")
+    def export_command(resource, fmt, user_id, compress, output):
+        """Stream a table as CSV or NDJSON without loading it into memory."""
+        from export import stream_export
+
+        for chunk in stream_export(resource, fmt, user_id, compress):
+            output.write(chunk)
+
+    @app.cli.command("import-data")
+    @click.argument("resource", type=_LazyChoice(_export_resources))
+    @click.argument("path", type=click.Path(exists=True, dir_okay=False))
+    @click.option("--format", "fmt", type=_LazyChoice(_export_formats), help="Default: from the file name.")
+    @click.option("--user-id", type=int, help="Assign every row to this user.")
+    @click.option("--batch-size", type=int, help="Rows per transaction.")
+    def import_data_command(resource, path, fmt, user_id, batch_size):
+        """Bulk-load CSV or NDJSON (optionally .gz); re-running a failed import resumes it."""
+        from importer import ImportFileError, detect_format, file_checksum, read_rows, run_import
+
+        with open(path, "rb") as fh:
+            checksum = file_checksum(fh)
+            rows = read_rows(fh, fmt or detect_format(path), compressed=path.lower().endswith(".gz"))
+            try:
+                result = run_import(
+                    resource, rows, checksum, source=os.path.basename(path), user_id=user_id, batch_size=batch_size,
+                    progress=lambda result: click.echo(result.summary(), err=True),
+                )
+            except ImportFileError as error:
+                raise click.ClickException(str(error))
+        for error in result.errors:
+            click.echo(error, err=True)
+        click.echo(result.summary())
+
+    @app.cli.command("rollup")
+    @click.option("--since", type=click.DateTime(formats=["%Y-%m-%d"]), help="Recount closed days from this date.")
+    def rollup_command(since):
+        """Close the daily activity rollups through yesterday, backfilling any missing days."""
+        from rollups import close_days, reopen_days
+
+        if since:
+            reopen_days(since.date())
+            db.session.commit()
+        closed = close_days(progress=lambda day: click.echo(f"closed through {day}", err=True))
+        click.echo(f"Closed {closed} day(s).")
+
+    @app.cli.command("worker")
+    @click.option("--burst", is_flag=True, help="Exit once no jobs are due.")
+    @click.option("--poll-interval", type=float, help="Seconds between polls when idle.")
+    @click.option("--visibility-timeout", type=int, help="Seconds before a running job may be taken over.")
+    def worker_command(burst, poll_interval, visibility_timeout):
+        """Run queued background jobs until interrupted."""
+        import signal
+
+        from jobs import Worker
+
+        worker = Worker(app, poll_interval=poll_interval, visibility_timeout=visibility_timeout)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: worker.stop())
+        click.echo(f"Worker {worker.worker_id} started.")
+        processed = worker.run(burst=burst)
+        click.echo(f"Worker stopped after {processed} job(s).")
+
+    @app.cli.command("enqueue-job")
+    @click.argument("kind", type=click.Choice(sorted(handlers)))
+    @click.option("--payload", default="{}", help="Handler arguments as a JSON object.")
+    @click.option("--delay", type=int, default=0, help="Seconds before the job is due.")
+    def enqueue_job_command(kind, payload, delay):
+        """Queue a background job, e.g. from cron."""
+        import json
+
+        from jobs import enqueue
+
+        job = enqueue(kind, json.loads(payload), delay=delay)
+        db.session.commit()
+        click.echo(f"Queued job {job.id} ({kind}).")
+
+    @app.cli.command("jobs")
+    def jobs_command():
+        """Show how many jobs are in each state."""
+        from jobs import job_counts
+
+        for status, count in job_counts().items():
+            click.echo(f"{status:<8} {count}")
+
+
+class _LazyChoice(click.Choice):
+    """A ``click.Choice`` whose choices are loaded when the command needs them.
+
+    Registering the commands then imports nothing that only they use.
+    """
+
+    def __init__(self, load, case_sensitive=True):
+        self._load = load
+        super().__init__((), case_sensitive=case_sensitive)
+
+    @property
+    def choices(self):
+        return tuple(self._load())
+
+    @choices.setter
+    def choices(self, value):
+        # Choice.__init__ stores its (here empty) choices; ignore them.
+        pass
+
+
+def _export_resources():
+    from export import EXPORTS
+
+    return EXPORTS
+
+
+def _export_formats():
+    from export import FORMATS
+
+    return FORMATS
+
+
+def _echo_migration(step):
+    click.echo(f"applying {step.version} {step.name}", err=True)
+
+
+app = create_app()
 
 if __name__ == "__main__":
+    with app.app_context():
+        init_db()
     app.run(debug=True, port=4000)
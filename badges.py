@@ -0,0 +1,131 @@
+from datetime import datetime
+
+from sqlalchemy import and_, exists, func, literal, select, union_all
+
+from dbutil import insert_ignore
+from extensions import db
+from habits import best_streak
+from models import Habit, HabitStreak, UserBadge, UserStats
+
+
+class Badge:
+    """A badge unlocked once every named metric reaches its threshold."""
+
+    __slots__ = ("id", "name", "desc", "emoji", "thresholds")
+
+    def __init__(self, id, name, desc, emoji, **thresholds):
+        self.id = id
+        self.name = name
+        self.desc = desc
+        self.emoji = emoji
+        self.thresholds = thresholds
+
+    def met(self, metrics):
+        return all(metrics[name] >= minimum for name, minimum in self.thresholds.items())
+
+    def condition(self, columns):
+        """The same test as :meth:`met`, as SQL over a metrics row."""
+        return and_(*(columns[name] >= minimum for name, minimum in self.thresholds.items()))
+
+    def as_dict(self):
+        return {"id": self.id, "name": self.name, "desc": self.desc, "emoji": self.emoji}
+
+
+# Metrics a threshold may name: the user_stats counters plus the longest
+# streak any of the user's habits reached.
+METRICS = UserStats.COUNTERS + ("best_streak",)
+
+BADGES = (
+    Badge("mood_explorer", "Mood Explorer", "Logged moods 5+ times", "🧭", moods=5),
+    Badge("task_slayer", "Task Slayer", "Completed 10 tasks", "✅", todos_done=10),
+    Badge("habit_streak", "Habit Streak", "Kept a habit going 7 times in a row", "🔥", best_streak=7),
+    Badge("consistency_pro", "Consistency Pro", "Kept a strong routine", "🏅", moods=20, todos_done=20),
+)
+
+BADGES_BY_ID = {badge.id: badge for badge in BADGES}
+
+
+def get_unlocked(user_id):
+    """Return ``{badge_id: unlocked_at}`` for the user."""
+    return dict(db.session.execute(
+        select(UserBadge.badge_id, UserBadge.unlocked_at).where(UserBadge.user_id == user_id)
+    ).all())
+
+
+def award_badges(user_id, counters):
+    """Unlock the badges the user now qualifies for and return all of theirs.
+
+    ``counters`` is the user's :func:`stats.get_user_stats` dict. Unlocked
+    badges are stored and never evaluated again; the habit streak is only
+    looked up while a badge that needs it is still locked.
+    """
+    unlocked = get_unlocked(user_id)
+    locked = [badge for badge in BADGES if badge.id not in unlocked]
+    if not locked:
+        return unlocked
+
+    metrics = dict(counters)
+    if any("best_streak" in badge.thresholds for badge in locked):
+        metrics["best_streak"] = best_streak(user_id)
+    earned = [badge.id for badge in locked if badge.met(metrics)]
+    if earned:
+        now = datetime.utcnow()
+        db.session.execute(
+            insert_ignore(UserBadge, ["user_id", "badge_id"]),
+            [dict(user_id=user_id, badge_id=badge_id, unlocked_at=now) for badge_id in earned],
+        )
+        db.session.commit()
+        unlocked.update(dict.fromkeys(earned, now))
+    return unlocked
+
+
+def _metrics(user_ids=None):
+    """One row of METRICS per user that has a user_stats row."""
+    streaks = (
+        select(Habit.user_id, func.max(HabitStreak.longest).label("best_streak"))
+        .join(HabitStreak, HabitStreak.habit_id == Habit.id)
+        .group_by(Habit.user_id)
+        .subquery("streaks")
+    )
+    stmt = select(
+        UserStats.user_id,
+        *(getattr(UserStats, name) for name in UserStats.COUNTERS),
+        func.coalesce(streaks.c.best_streak, 0).label("best_streak"),
+    ).outerjoin(streaks, streaks.c.user_id == UserStats.user_id)
+    if user_ids is not None:
+        stmt = stmt.where(UserStats.user_id.in_(user_ids))
+    return stmt.cte("metrics")
+
+
+def sync_badges(user_ids=None):
+    """Evaluate every badge for many users at once and store new unlocks.
+
+    The metrics are computed once in a CTE and each badge becomes one
+    branch of a single INSERT ... SELECT, so the whole pass is one statement
+    whatever the number of users. Users without a user_stats row (run
+    ``flask rebuild-stats`` first) and habits whose streak has not been
+    cached yet count as zero. Returns the new ``(user_id, badge_id)`` pairs;
+    the caller commits.
+    """
+    metrics = _metrics(user_ids)
+    now = datetime.utcnow()
+    branches = [
+        select(metrics.c.user_id, literal(badge.id, UserBadge.badge_id.type), literal(now, UserBadge.unlocked_at.type))
+        .where(
+            badge.condition(metrics.c),
+            ~exists().where(UserBadge.user_id == metrics.c.user_id, UserBadge.badge_id == badge.id),
+        )
+        for badge in BADGES
+    ]
+    stmt = (
+        insert_ignore(UserBadge, ["user_id", "badge_id"])
+        .from_select(["user_id", "badge_id", "unlocked_at"], union_all(*branches))
+        .returning(UserBadge.user_id, UserBadge.badge_id)
+    )
+    return [tuple(row) for row in db.session.execute(stmt)]
+
+
+def badge_counts():
+    """Return ``{badge_id: number of users who unlocked it}``."""
+    counts = dict(db.session.execute(select(UserBadge.badge_id, func.count()).group_by(UserBadge.badge_id)).all())
+    return {badge.id: counts.get(badge.id, 0) for badge in BADGES}
@@ -0,0 +1,279 @@
+"""Drive the main pages with synthetic data and report latency percentiles.
+
+Usage:
+    python benchmarks/bench.py [--users 200] [--seed 1] [--requests 50]
+                               [--gunicorn [--workers 2] | --url http://127.0.0.1:8000 --skip-seed]
+                               [--save baseline.json] [--compare baseline.json] [--tolerance 0.2]
+
+Seeds a scratch SQLite database (or DATABASE_URL with ``--database-url``)
+through ``benchmarks/synthetic.py`` and requests each page ``--requests``
+times as one typical user and as the admin. By default it goes through the
+Flask test client; ``--gunicorn`` starts gunicorn on the same database and
+``--url`` targets a server that is already running. Queries per request are
+read from the Server-Timing header, so servers must run with PROFILING=1
+(the harness sets it for the ones it starts).
+
+``--save`` writes p50/p95/p99 and queries per endpoint to JSON. ``--compare``
+prints the change against such a file and exits with status 1 when a p95
+grows by more than ``--tolerance`` or an endpoint issues more queries.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+USER_PAGES = ["/tracker", "/progress", "/badges", "/mood", "/habit"]
+ADMIN_PAGES = ["/admin"]
+WARMUP = 3
+
+_QUERIES = re.compile(r'desc="(\d+) queries"')
+_CSRF = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+def _queries(server_timing):
+    match = _QUERIES.search(server_timing or "")
+    return int(match.group(1)) if match else None
+
+
+class TestClientDriver:
+    """Requests through Flask's test client, in this process."""
+
+    def __init__(self, app):
+        self.app = app
+        self.client = app.test_client()
+
+    def get(self, path):
+        response = self.client.get(path)
+        return response.status_code, _queries(response.headers.get("Server-Timing"))
+
+    def login(self, email, password):
+        response = self.client.post("/login", data={"email": email, "password": password})
+        return response.status_code, _queries(response.headers.get("Server-Timing"))
+
+    def fresh(self):
+        return TestClientDriver(self.app)
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpDriver:
+    """Requests over HTTP to a running server, keeping cookies like a browser."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect()
+        )
+
+    def _open(self, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            response = self.opener.open(self.base_url + path, body)
+        except urllib.error.HTTPError as error:
+            response = error
+        with response:
+            return response.status, response.headers.get("Server-Timing"), response.read()
+
+    def get(self, path):
+        status, timing, _body = self._open(path)
+        return status, _queries(timing)
+
+    def login(self, email, password):
+        _status, _timing, body = self._open("/login")
+        match = _CSRF.search(body.decode())
+        data = {"email": email, "password": password, "csrf_token": match.group(1) if match else ""}
+        status, timing, _body = self._open("/login", data)
+        return status, _queries(timing)
+
+    def fresh(self):
+        return HttpDriver(self.base_url)
+
+
+def _measure(call, count):
+    for _ in range(WARMUP):
+        call()
+    latencies, queries = [], []
+    for _ in range(count):
+        start = time.perf_counter()
+        status, query_count = call()
+        latencies.append((time.perf_counter() - start) * 1000)
+        if status >= 400:
+            raise SystemExit(f"request failed with HTTP {status}")
+        if query_count is not None:
+            queries.append(query_count)
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "p50": cuts[49],
+        "p95": cuts[94],
+        "p99": cuts[98],
+        "queries": statistics.mean(queries) if queries else None,
+    }
+
+
+def run(driver, requests, typical_email):
+    from synthetic import ADMIN_EMAIL, PASSWORD
+
+    results = {}
+    user = driver.fresh()
+    user.login(typical_email, PASSWORD)
+    for path in USER_PAGES:
+        results[path] = _measure(lambda: user.get(path), requests)
+
+    admin = driver.fresh()
+    admin.login(ADMIN_EMAIL, PASSWORD)
+    for path in ADMIN_PAGES:
+        results[path] = _measure(lambda: admin.get(path), requests)
+
+    results["POST /login"] = _measure(lambda: driver.fresh().login(typical_email, PASSWORD), requests)
+    return results
+
+
+def _typical_user():
+    """The user with the median amount of data, so pages are neither empty nor extreme."""
+    from sqlalchemy import select
+
+    from extensions import db
+    from models import User, UserStats
+
+    rows = db.session.execute(
+        select(User.email)
+        .join(UserStats, UserStats.user_id == User.id)
+        .where(User.is_admin.is_(False))
+        .order_by(UserStats.moods + UserStats.todos + UserStats.habit_entries, User.id)
+    ).scalars().all()
+    if not rows:
+        raise SystemExit("no seeded users found; run without --skip-seed")
+    return rows[len(rows) // 2]
+
+
+def _start_gunicorn(env, workers, port):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-w", str(workers), "-b", f"127.0.0.1:{port}", "app:app"],
+        cwd=REPO, env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url + "/login").close()
+            return process, url
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("gunicorn did not start")
+
+
+def _print(results, baseline=None):
+    print(f"{'endpoint':<14} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8}" + ("  vs baseline" if baseline else ""))
+    for name, r in results.items():
+        queries = f"{r['queries']:.1f}" if r["queries"] is not None else "-"
+        line = f"{name:<14} {r['p50']:>8.2f} {r['p95']:>8.2f} {r['p99']:>8.2f} {queries:>8}"
+        if baseline and name in baseline:
+            before = baseline[name]
+            line += f"  p95 {(r['p95'] / before['p95'] - 1) * 100:+.0f}%"
+            if r["queries"] is not None and before["queries"] is not None:
+                line += f", queries {r['queries'] - before['queries']:+.1f}"
+        print(line)
+
+
+def _regressions(results, baseline, tolerance):
+    found = []
+    for name, r in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if r["p95"] > before["p95"] * (1 + tolerance):
+            found.append(f"{name}: p95 {before['p95']:.2f} -> {r['p95']:.2f} ms")
+        if r["queries"] is not None and before["queries"] is not None and r["queries"] > before["queries"]:
+            found.append(f"{name}: queries {before['queries']:.1f} -> {r['queries']:.1f}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--database-url", help="Seed and serve this database instead of a scratch SQLite file.")
+    parser.add_argument("--skip-seed", action="store_true", help="Use the data already in the database.")
+    parser.add_argument("--gunicorn", action="store_true", help="Serve the app with gunicorn instead of the test client.")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--url", help="Benchmark a server that is already running.")
+    parser.add_argument("--save", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Compare against results saved with --save.")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    database_url = args.database_url or os.getenv("DATABASE_URL")
+    if not database_url:
+        database_url = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["PROFILING"] = "1"
+
+    from app import create_app, init_db
+    from synthetic import generate
+
+    app = create_app({"WTF_CSRF_ENABLED": False})
+    with app.app_context():
+        if not args.skip_seed:
+            init_db()
+            counts = generate(args.users, args.seed)
+            print("seeded " + ", ".join(f"{count} {name}" for name, count in counts.items()))
+        typical_email = _typical_user()
+
+    server = None
+    if args.url:
+        driver, mode = HttpDriver(args.url), args.url
+    elif args.gunicorn:
+        server, url = _start_gunicorn(dict(os.environ), args.workers, args.port)
+        driver, mode = HttpDriver(url), f"gunicorn -w {args.workers}"
+    else:
+        driver, mode = TestClientDriver(app), "test client"
+    try:
+        results = run(driver, args.requests, typical_email)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)["results"]
+    print(f"{mode}, {args.requests} requests per endpoint, user {typical_email}")
+    _print(results, baseline)
+
+    if args.save:
+        meta = {"mode": mode, "users": args.users, "seed": args.seed, "requests": args.requests,
+                "database": database_url.split(":", 1)[0], "python": platform.python_version()}
+        with open(args.save, "w") as fh:
+            json.dump({"meta": meta, "results": results}, fh, indent=2)
+        print(f"saved {args.save}")
+
+    if baseline is not None:
+        regressions = _regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
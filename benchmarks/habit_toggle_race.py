@@ -0,0 +1,77 @@
+"""Hammer the habit completion toggle from many threads and check invariants.
+
+Usage:
+    python benchmarks/habit_toggle_race.py [--threads 8] [--toggles 50]
+
+Runs against a scratch SQLite database. Each thread logs in as the same user
+and toggles the same habit (plus "complete all") as fast as it can. At the end
+there must be no server errors, at most one entry per habit and day, and
+user_stats must agree with a full recount.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+from collections import Counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--toggles", type=int, default=50)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tmp, "race.db")
+
+    from app import create_app, init_db
+    from extensions import db
+    from models import Habit, HabitEntry, User
+    from stats import rebuild_user_stats
+
+    app = create_app({"WTF_CSRF_ENABLED": False, "PASSWORD_HASH_METHOD": "pbkdf2:sha256:1000"})
+    with app.app_context():
+        init_db()
+        user = User(username="racer", email="racer@example.com")
+        user.set_password("password123")
+        db.session.add(user)
+        db.session.flush()
+        db.session.add_all([Habit(habit=f"habit {i}", frequency="Daily", user_id=user.id) for i in range(3)])
+        db.session.commit()
+        habit_id = Habit.query.filter_by(user_id=user.id).first().id
+
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def worker(n):
+        client = app.test_client()
+        client.post("/login", data={"email": "racer@example.com", "password": "password123"})
+        for i in range(args.toggles):
+            url = "/habit/complete-all" if (n + i) % 5 == 0 else f"/habit/complete/{habit_id}"
+            status = client.post(url).status_code
+            with lock:
+                statuses[status] += 1
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with app.app_context():
+        per_day = Counter((e.habit_id, e.date) for e in HabitEntry.query.all())
+        duplicates = [key for key, count in per_day.items() if count > 1]
+        drift = rebuild_user_stats(fix=False)
+
+    print("responses:", dict(statuses))
+    print("duplicate entries:", duplicates)
+    print("user_stats drift:", [row for row in drift if row[1] is not None])
+    failed = any(status >= 500 for status in statuses) or duplicates or any(row[1] is not None for row in drift)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
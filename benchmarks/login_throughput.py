@@ -0,0 +1,69 @@
+"""Measure password-check throughput for different pool sizes and hash costs.
+
+Usage:
+    python benchmarks/login_throughput.py [--logins 64] [--workers 1 2 4] [--iterations 100000 600000]
+
+Simulates a login burst: ``--logins`` request threads each verify a password
+through the shared hashing pool, and the script reports logins per second and
+the latency of a cheap request that runs alongside the burst.
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import hashing  # noqa: E402
+
+
+def run(workers, iterations, logins):
+    method = f"pbkdf2:sha256:{iterations}"
+    pwhash = generate_password_hash("correct horse", method)
+    hashing._executor = ThreadPoolExecutor(max_workers=workers)
+
+    done = threading.Event()
+    side_latencies = []
+
+    def cheap_request():
+        while not done.is_set():
+            start = time.perf_counter()
+            sum(range(10_000))
+            side_latencies.append((time.perf_counter() - start) * 1000)
+
+    side = threading.Thread(target=cheap_request)
+    side.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=logins) as request_threads:
+        list(request_threads.map(lambda _: hashing.verify_password(pwhash, "correct horse"), range(logins)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    side.join()
+    hashing._executor.shutdown()
+    hashing._executor = None
+
+    p95 = statistics.quantiles(side_latencies, n=20)[-1] if len(side_latencies) > 1 else 0.0
+    return logins / elapsed, p95
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--iterations", type=int, nargs="+", default=[100_000, 600_000])
+    args = parser.parse_args()
+
+    print(f"{'iterations':>10} {'workers':>7} {'logins/s':>9} {'side p95 ms':>11}")
+    for iterations in args.iterations:
+        for workers in args.workers:
+            rate, p95 = run(workers, iterations, args.logins)
+            print(f"{iterations:>10} {workers:>7} {rate:>9.1f} {p95:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
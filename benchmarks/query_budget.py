@@ -0,0 +1,108 @@
+"""Check that each page runs a fixed number of queries, however much data there is.
+
+Usage:
+    python benchmarks/query_budget.py [--small 3] [--large 60]
+
+Seeds two scratch SQLite databases with ``benchmarks/synthetic.py`` and
+loads every listed page as the busiest user and as the admin, with
+STRICT_LOADING on so a lazy load inside a template fails the page outright.
+A page fails when it runs more queries than its budget on either dataset.
+Exits with status 1 on any failure.
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+# Queries per page on a warm request (user_stats and habit_streaks rows exist,
+# daily rollups are closed through yesterday).
+# /tracker and /badges look up the best habit streak while the streak badge
+# is still locked.
+USER_BUDGETS = {
+    "/tracker": 4,
+    "/progress": 4,
+    "/badges": 4,
+    "/mood": 2,
+    "/todo": 2,
+    "/habit": 5,
+    "/tips": 2,
+    "/tips/search?q=break": 3,
+    "/tip/1": 2,
+}
+ADMIN_BUDGETS = {
+    "/admin": 5,
+    "/admin/tips": 1,
+    "/admin/users": 1,
+    "/admin/badges": 2,
+}
+
+
+def measure(users, seed):
+    """Return ``{path: query count}`` for a database seeded with ``users`` users."""
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "budget.db")
+
+    from sqlalchemy import event, select
+
+    from app import create_app, init_db
+    from cache import fragment_cache
+    from extensions import db
+    from models import User, UserStats
+    from rollups import close_days
+    from synthetic import ADMIN_EMAIL, PASSWORD, generate
+
+    app = create_app({"WTF_CSRF_ENABLED": False, "STRICT_LOADING": True, "PASSWORD_HASH_METHOD": "pbkdf2:sha256:1000"})
+    with app.app_context():
+        init_db()
+        generate(users, seed)
+        close_days()
+        busiest = db.session.scalar(
+            select(User.email)
+            .join(UserStats, UserStats.user_id == User.id)
+            .where(User.is_admin.is_(False))
+            .order_by((UserStats.moods + UserStats.todos + UserStats.habit_entries).desc())
+        )
+        engine = db.engine
+
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    counts = {}
+    for email, budgets in ((busiest, USER_BUDGETS), (ADMIN_EMAIL, ADMIN_BUDGETS)):
+        client = app.test_client()
+        client.post("/login", data={"email": email, "password": PASSWORD})
+        for path in budgets:
+            client.get(path)  # warm-up: builds cached rows such as habit streaks
+            fragment_cache.backend.clear()
+            statements.clear()
+            response = client.get(path)
+            if response.status_code != 200:
+                raise SystemExit(f"{path} returned HTTP {response.status_code} with {users} users")
+            counts[path] = len(statements)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--small", type=int, default=3, help="Users in the small dataset.")
+    parser.add_argument("--large", type=int, default=60, help="Users in the large dataset.")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    small = measure(args.small, args.seed)
+    large = measure(args.large, args.seed)
+    budgets = {**USER_BUDGETS, **ADMIN_BUDGETS}
+
+    failures = 0
+    print(f"{'page':<22} {'budget':>6} {'small':>6} {'large':>6}")
+    for path, budget in budgets.items():
+        ok = large[path] <= budget and small[path] <= budget
+        failures += not ok
+        print(f"{path:<22} {budget:>6} {small[path]:>6} {large[path]:>6}{'' if ok else '  FAIL'}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
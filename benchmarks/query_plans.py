@@ -0,0 +1,126 @@
+"""Show query plans and timings for the per-user views with and without indexes.
+
+Usage:
+    python benchmarks/query_plans.py [--users 200] [--rows 500] [--url sqlite:///bench.db]
+
+Builds a scratch database, fills it with synthetic rows, then runs the queries
+issued by the mood/todo/habit/progress views twice: once with only the primary
+keys and once with the indexes declared in models.py.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import create_engine, insert, text
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from extensions import db  # noqa: E402
+from models import Habit, HabitEntry, Mood, ToDo, User  # noqa: E402
+
+QUERIES = {
+    "mood list": "SELECT * FROM moods WHERE user_id = :uid ORDER BY created_at DESC",
+    "todo list": "SELECT * FROM todos WHERE user_id = :uid ORDER BY created_at DESC",
+    "todo done count": "SELECT count(*) FROM todos WHERE user_id = :uid AND done = :done",
+    "habit list": "SELECT * FROM habits WHERE user_id = :uid ORDER BY created_at DESC",
+    "habit entries today": (
+        "SELECT habit_entries.* FROM habit_entries JOIN habits ON habits.id = habit_entries.habit_id "
+        "WHERE habits.user_id = :uid AND habit_entries.date = :today"
+    ),
+    "progress moods": "SELECT * FROM moods WHERE user_id = :uid AND created_at >= :since",
+}
+
+
+def explain_prefix(engine):
+    return "EXPLAIN QUERY PLAN " if engine.dialect.name == "sqlite" else "EXPLAIN "
+
+
+def seed(engine, users, rows):
+    rng = random.Random(42)
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(insert(User.__table__), [
+            {"id": i, "username": f"user{i}", "email": f"user{i}@bench.test", "password_hash": "x",
+             "is_admin": False, "created_at": now}
+            for i in range(1, users + 1)
+        ])
+        for uid in range(1, users + 1):
+            stamps = [now - timedelta(minutes=rng.randint(0, 60 * 24 * 365)) for _ in range(rows)]
+            conn.execute(insert(Mood.__table__), [
+                {"mood": "Happy", "user_id": uid, "created_at": ts} for ts in stamps
+            ])
+            conn.execute(insert(ToDo.__table__), [
+                {"task": "task", "done": rng.random() < 0.5, "user_id": uid, "created_at": ts} for ts in stamps
+            ])
+            conn.execute(insert(Habit.__table__), [
+                {"id": (uid - 1) * 5 + h, "habit": "habit", "frequency": "Daily", "user_id": uid, "created_at": now}
+                for h in range(1, 6)
+            ])
+            conn.execute(insert(HabitEntry.__table__), [
+                {"habit_id": (uid - 1) * 5 + h, "date": date.today() - timedelta(days=d), "created_at": now}
+                for h in range(1, 6)
+                for d in range(rows // 5)
+            ])
+
+
+def run_queries(engine, uid, repeat):
+    params = {
+        "uid": uid,
+        "done": True,
+        "today": date.today(),
+        "since": datetime.utcnow() - timedelta(days=14),
+    }
+    results = {}
+    with engine.connect() as conn:
+        for name, sql in QUERIES.items():
+            plan = conn.execute(text(explain_prefix(engine) + sql), params).fetchall()
+            start = time.perf_counter()
+            for _ in range(repeat):
+                conn.execute(text(sql), params).fetchall()
+            elapsed = (time.perf_counter() - start) / repeat * 1000
+            results[name] = (plan, elapsed)
+    return results
+
+
+def print_results(title, results):
+    print(f"\n=== {title} ===")
+    for name, (plan, elapsed) in results.items():
+        print(f"{name:<22} {elapsed:8.3f} ms")
+        for row in plan:
+            print("    " + " | ".join(str(col) for col in row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rows", type=int, default=500, help="moods/todos per user")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--url", default="sqlite:///:memory:")
+    args = parser.parse_args()
+
+    engine = create_engine(args.url)
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    indexes = [index for table in db.metadata.sorted_tables for index in table.indexes]
+    for index in indexes:
+        index.drop(engine)
+
+    seed(engine, args.users, args.rows)
+    uid = args.users // 2
+    before = run_queries(engine, uid, args.repeat)
+
+    for index in indexes:
+        index.create(engine)
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE"))
+    after = run_queries(engine, uid, args.repeat)
+
+    print_results("without indexes", before)
+    print_results("with indexes", after)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Check that importing the app is fast and does not touch the database.
+
+Usage:
+    python benchmarks/startup.py [--runs 5] [--budget-ms 1500]
+
+Imports ``app`` in fresh interpreters pointed at a database file that does not
+exist yet, reports the median wall time and exits non-zero if the budget is
+exceeded or the import created the database.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=1500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "startup.db")
+        env = dict(os.environ, DATABASE_URL="sqlite:///" + db_path)
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", "import app"], cwd=ROOT, env=env, check=True)
+            timings.append((time.perf_counter() - start) * 1000)
+        touched_db = os.path.exists(db_path)
+
+    median = statistics.median(timings)
+    print(f"import app: median {median:.0f} ms over {args.runs} runs (budget {args.budget_ms:.0f} ms)")
+    if touched_db:
+        print("FAIL: importing the app created the database")
+    if median > args.budget_ms:
+        print("FAIL: startup budget exceeded")
+    sys.exit(1 if touched_db or median > args.budget_ms else 0)
+
+
+if __name__ == "__main__":
+    main()
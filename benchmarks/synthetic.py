@@ -0,0 +1,148 @@
+"""Fill a database with deterministic synthetic users and their history.
+
+Usage:
+    python benchmarks/synthetic.py [--users 200] [--seed 1] [--days 365] [--today 2025-01-01]
+
+Writes to DATABASE_URL (SQLite or a local Postgres), creating the schema
+first. The same ``--seed`` and ``--today`` always produce the same rows.
+Users are ``user<N>@example.com`` and the admin is ``bench-admin@example.com``,
+all with the password ``password123``. Activity per user is log-normal, so
+a few users are heavy and most are light; habit completions follow a
+two-state chain, which gives realistic streaks and gaps.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+PASSWORD = "password123"
+ADMIN_EMAIL = "bench-admin@example.com"
+CHUNK = 5000
+
+MOOD_WEIGHTS = {"Happy": 25, "Content": 25, "Neutral": 20, "Sad": 10, "Anxious": 10, "Excited": 10}
+FREQUENCY_WEIGHTS = {"Daily": 60, "Weekly": 25, "Monthly": 10, "Custom": 5}
+# Chance of completing a habit on a given day, after a miss / after a completion.
+HABIT_CHAIN = {"Daily": (0.35, 0.8), "Weekly": (0.12, 0.2), "Monthly": (0.03, 0.05), "Custom": (0.25, 0.6)}
+HABIT_NAMES = ["Read 20 pages", "Walk 5k steps", "Meditate", "Drink water", "Stretch", "Journal", "No phone in bed"]
+TIP_CATEGORIES = ["Mindfulness", "Energy", "Reflection", "Sleep", "Focus"]
+
+
+def _moment(rng, start, today):
+    """A random datetime between ``start`` and the end of ``today``."""
+    span = max((today - start).days, 0)
+    day = start + timedelta(days=rng.randint(0, span))
+    return datetime.combine(day, datetime.min.time()) + timedelta(seconds=rng.randint(8 * 3600, 23 * 3600))
+
+
+def _insert(model, rows, returning=None):
+    from sqlalchemy import insert
+
+    from extensions import db
+
+    ids = []
+    for i in range(0, len(rows), CHUNK):
+        chunk = rows[i:i + CHUNK]
+        if returning is not None:
+            ids.extend(db.session.scalars(insert(model).returning(returning), chunk).all())
+        else:
+            db.session.execute(insert(model), chunk)
+    return ids
+
+
+def generate(users, seed=1, days=365, today=None):
+    """Insert ``users`` synthetic users with moods, todos, habits and entries.
+
+    Needs an app context with an empty schema. Returns row counts per table.
+    """
+    from extensions import db
+    from hashing import hash_password
+    from models import Habit, HabitEntry, Mood, Tip, ToDo, User
+    from stats import rebuild_user_stats
+
+    rng = random.Random(seed)
+    today = today or date.today()
+    first_day = today - timedelta(days=days)
+    pwhash = hash_password(PASSWORD)
+
+    user_rows = [dict(username="bench-admin", email=ADMIN_EMAIL, password_hash=pwhash, is_admin=True,
+                      created_at=datetime.combine(first_day, datetime.min.time()))]
+    for n in range(users):
+        user_rows.append(dict(username=f"user{n}", email=f"user{n}@example.com", password_hash=pwhash,
+                              is_admin=False, created_at=_moment(rng, first_day, today)))
+    user_ids = _insert(User, user_rows, returning=User.id)
+    admin_id = user_ids[0]
+
+    moods, todos, habits = [], [], []
+    for user_id, user in zip(user_ids[1:], user_rows[1:]):
+        joined = user["created_at"].date()
+        active_days = max((today - joined).days, 1)
+        activity = min(rng.lognormvariate(0, 0.8), 6.0)
+        for _ in range(int(active_days * 0.4 * activity)):
+            moods.append(dict(user_id=user_id, mood=rng.choices(list(MOOD_WEIGHTS), list(MOOD_WEIGHTS.values()))[0],
+                              notes=rng.choice([None, "Slept well", "Busy day", "Long walk"]),
+                              created_at=_moment(rng, joined, today)))
+        for i in range(int(active_days * 0.25 * activity)):
+            todos.append(dict(user_id=user_id, task=f"Task {i}", detail=None, done=rng.random() < 0.7,
+                              created_at=_moment(rng, joined, today)))
+        for name in rng.sample(HABIT_NAMES, rng.randint(0, 4)):
+            habits.append(dict(user_id=user_id, habit=name,
+                               frequency=rng.choices(list(FREQUENCY_WEIGHTS), list(FREQUENCY_WEIGHTS.values()))[0],
+                               created_at=_moment(rng, joined, today)))
+    _insert(Mood, moods)
+    _insert(ToDo, todos)
+    habit_ids = _insert(Habit, habits, returning=Habit.id)
+
+    entries = []
+    for habit_id, habit in zip(habit_ids, habits):
+        after_miss, after_done = HABIT_CHAIN[habit["frequency"]]
+        done = False
+        day = habit["created_at"].date()
+        while day <= today:
+            done = rng.random() < (after_done if done else after_miss)
+            if done:
+                entries.append(dict(habit_id=habit_id, date=day,
+                                    created_at=datetime.combine(day, datetime.min.time()) + timedelta(hours=20)))
+            day += timedelta(days=1)
+    _insert(HabitEntry, entries)
+
+    tips = [
+        dict(title=f"Tip {i}", body="Take a short break and breathe.", category=rng.choice(TIP_CATEGORIES),
+             author_id=admin_id, created_at=_moment(rng, first_day, today))
+        for i in range(50)
+    ]
+    for tip in tips:
+        tip["updated_at"] = tip["created_at"]
+    _insert(Tip, tips)
+    db.session.commit()
+    rebuild_user_stats(fix=True)
+    return {"users": len(user_rows), "moods": len(moods), "todos": len(todos), "habits": len(habits),
+            "habit_entries": len(entries), "tips": len(tips)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--today", type=date.fromisoformat, default=None)
+    args = parser.parse_args()
+
+    from app import create_app, init_db
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+        start = time.perf_counter()
+        counts = generate(args.users, args.seed, args.days, args.today)
+        elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    print(", ".join(f"{count} {name}" for name, count in counts.items()))
+    print(f"{total} rows in {elapsed:.1f}s ({total / elapsed:,.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
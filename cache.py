@@ -0,0 +1,103 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from flask import current_app
+from markupsafe import Markup
+
+
+class TTLCache:
+    """Thread-safe, process-local LRU whose entries expire after a TTL.
+
+    This is the default backend for FragmentCache. A shared backend (Redis,
+    memcached) only needs the same ``get``/``set``/``delete`` methods.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            expires_at = time.monotonic() + ttl if ttl else None
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FragmentCache:
+    """Cache of rendered HTML fragments grouped into namespaces.
+
+    Keys are prefixed with a per-namespace generation, so ``invalidate(ns)``
+    drops every fragment in the namespace at once and ``invalidate(ns, key)``
+    drops a single one.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or TTLCache()
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def _ttl(self):
+        return current_app.config.get("FRAGMENT_CACHE_TTL", 300)
+
+    def _generation(self, namespace):
+        gen_key = f"gen:{namespace}"
+        generation = self.backend.get(gen_key)
+        if generation is None:
+            # Never restart from a fixed value: a lost generation key must not
+            # resurrect fragments that were written under an older one.
+            generation = time.time_ns()
+            self.backend.set(gen_key, generation)
+        return generation
+
+    def _key(self, namespace, key):
+        return f"frag:{namespace}:{self._generation(namespace)}:{key}"
+
+    def get_or_render(self, namespace, key, render):
+        full_key = self._key(namespace, key)
+        html = self.backend.get(full_key)
+        if html is not None:
+            self.hits[namespace] += 1
+            return Markup(html)
+        self.misses[namespace] += 1
+        html = str(render())
+        self.backend.set(full_key, html, self._ttl())
+        return Markup(html)
+
+    def invalidate(self, namespace, key=None):
+        if key is None:
+            self.backend.set(f"gen:{namespace}", time.time_ns())
+        else:
+            self.backend.delete(self._key(namespace, key))
+
+    def stats(self):
+        return {
+            namespace: {"hits": self.hits[namespace], "misses": self.misses[namespace]}
+            for namespace in sorted(set(self.hits) | set(self.misses))
+        }
+
+
+fragment_cache = FragmentCache()
@@ -0,0 +1,90 @@
+import hashlib
+import os
+import time
+from functools import lru_cache
+
+from flask import Response, g, request, session
+
+# Pages with forms carry a time-limited CSRF token, so their validators roll
+# over well inside Flask-WTF's default one-hour token lifetime.
+FORM_VALIDATOR_WINDOW = 1800
+
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+
+def not_modified(*version, last_modified=None, user=None, forms=False):
+    """Return a 304 response when the client already has this version of the page.
+
+    ``version`` is whatever cheaply identifies the page's data (a timestamp,
+    a count). The validators are remembered on ``g`` and added to the full
+    response by :func:`add_validators`. Returns ``None`` when the page must be
+    rendered.
+    """
+    if request.method != "GET" or session.get("_flashes"):
+        return None
+
+    parts = [request.full_path, user.id if user else None, user.is_admin if user else None, *version]
+    if forms:
+        # Logging in or out clears the session and with it the CSRF secret,
+        # which turns every cached token invalid.
+        parts.extend((int(time.time() // FORM_VALIDATOR_WINDOW), session.get("csrf_token")))
+    etag = hashlib.sha1(repr(parts).encode()).hexdigest()
+    if last_modified is not None:
+        last_modified = last_modified.replace(microsecond=0)
+    g._validators = (etag, last_modified, user is not None)
+
+    if request.if_none_match:
+        matched = request.if_none_match.contains_weak(etag)
+    else:
+        matched = (
+            last_modified is not None
+            and request.if_modified_since is not None
+            and request.if_modified_since.replace(tzinfo=None) >= last_modified
+        )
+    if not matched:
+        return None
+    return add_validators(Response(status=304))
+
+
+def add_validators(response):
+    validators = g.pop("_validators", None)
+    if validators is None or response.status_code not in (200, 304):
+        return response
+    etag, last_modified, private = validators
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    if private:
+        response.cache_control.private = True
+    response.vary.add("Cookie")
+    return response
+
+
+@lru_cache(maxsize=512)
+def _file_hash(path, mtime):
+    with open(path, "rb") as fh:
+        return hashlib.sha1(fh.read()).hexdigest()[:12]
+
+
+def init_static_fingerprints(app):
+    """Add a content hash to static URLs and cache those URLs for a year."""
+
+    @app.url_defaults
+    def fingerprint_static(endpoint, values):
+        if endpoint != "static" or "filename" not in values or "v" in values:
+            return
+        path = os.path.join(app.static_folder, values["filename"])
+        try:
+            values["v"] = _file_hash(path, os.path.getmtime(path))
+        except OSError:
+            pass
+
+    @app.after_request
+    def cache_fingerprinted_static(response):
+        if request.endpoint == "static" and request.args.get("v") and response.status_code == 200:
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+        return response
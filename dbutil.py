@@ -0,0 +1,83 @@
+import re
+
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import raiseload
+from sqlalchemy.schema import CreateIndex
+
+from extensions import db
+
+
+def dialect_name():
+    return db.session.get_bind().dialect.name
+
+
+def insert_ignore(model, index_elements):
+    """INSERT that skips rows violating the unique key on ``index_elements``.
+
+    Both SQLite and Postgres spell this ``ON CONFLICT (...) DO NOTHING``, but
+    SQLAlchemy exposes it through each dialect's own insert construct.
+    """
+    dialect = postgresql if dialect_name() == "postgresql" else sqlite
+    return dialect.insert(model).on_conflict_do_nothing(index_elements=index_elements)
+
+
+def upsert(model, index_elements, columns):
+    """INSERT that overwrites ``columns`` of the row already holding the unique key on ``index_elements``.
+
+    ``ON CONFLICT (...) DO UPDATE`` on both SQLite and Postgres, so
+    concurrent writers of the same row never fail on the key.
+    """
+    dialect = postgresql if dialect_name() == "postgresql" else sqlite
+    stmt = dialect.insert(model)
+    return stmt.on_conflict_do_update(
+        index_elements=index_elements, set_={name: stmt.excluded[name] for name in columns}
+    )
+
+
+def index_ddl(index):
+    """``CREATE INDEX IF NOT EXISTS`` for a model's :class:`~sqlalchemy.Index`, in this database's dialect."""
+    return str(CreateIndex(index, if_not_exists=True).compile(dialect=db.engine.dialect))
+
+
+def create_index_online(name, ddl):
+    """Run ``CREATE [UNIQUE] INDEX IF NOT EXISTS ...`` without blocking writes.
+
+    On Postgres the index is built ``CONCURRENTLY``, which cannot run inside a
+    transaction, so the session's transaction is committed first and the DDL
+    runs on its own autocommit connection. A concurrent build that failed
+    halfway leaves an invalid index behind, which ``IF NOT EXISTS`` would
+    keep forever; it is dropped and built again. SQLite has no concurrent
+    builds and locks the database for the (short) duration anyway.
+    """
+    db.session.commit()
+    if dialect_name() != "postgresql":
+        db.session.execute(text(ddl))
+        db.session.commit()
+        return
+    ddl = re.sub(r"^CREATE (UNIQUE )?INDEX ", r"CREATE \1INDEX CONCURRENTLY ", ddl.strip())
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        invalid = connection.execute(
+            text(
+                "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+                "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"
+            ),
+            {"name": name},
+        ).first()
+        if invalid:
+            connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+        connection.execute(text(ddl))
+
+
+def view_options(*eager):
+    """Loader options for a page's query: the relationships its template uses.
+
+    Everything else stays unloaded. With ``STRICT_LOADING`` (on under
+    ``TESTING``) touching any other relationship raises instead of quietly
+    issuing one query per row.
+    """
+    options = list(eager)
+    if current_app.config.get("STRICT_LOADING"):
+        options.append(raiseload("*", sql_only=True))
+    return options
@@ -0,0 +1,125 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _env_bool(name, default):
+    value = os.getenv(name)
+    if value in (None, ""):
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+class PoolMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.slow_checkouts = 0
+        self.in_use = 0
+        self.capacity = 0
+
+    def record_checkout(self, wait, in_use, capacity, slow_threshold):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.in_use = in_use
+            self.capacity = capacity
+            if wait >= slow_threshold:
+                self.slow_checkouts += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "checkout_wait_avg_ms": (self.wait_total / self.checkouts * 1000) if self.checkouts else 0.0,
+                "checkout_wait_max_ms": self.wait_max * 1000,
+                "slow_checkouts": self.slow_checkouts,
+                "in_use": self.in_use,
+                "capacity": self.capacity,
+                "saturation": (self.in_use / self.capacity) if self.capacity else 0.0,
+            }
+
+
+pool_metrics = PoolMetrics()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long callers wait for a connection."""
+
+    slow_checkout_seconds = 0.1
+
+    def __init__(self, creator, pool_size=5, max_overflow=10, **kw):
+        super().__init__(creator, pool_size=pool_size, max_overflow=max_overflow, **kw)
+        self.capacity = pool_size + max(max_overflow, 0)
+
+    def connect(self):
+        # No pool event fires before a checkout starts waiting, so time the
+        # public entry point; a timeout after pool_timeout is counted too.
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            wait = time.perf_counter() - start
+            in_use = self.checkedout()
+            pool_metrics.record_checkout(wait, in_use, self.capacity, self.slow_checkout_seconds)
+            if wait >= self.slow_checkout_seconds:
+                logger.warning(
+                    "Waited %.0f ms for a DB connection (%d/%d in use)", wait * 1000, in_use, self.capacity
+                )
+
+
+def engine_options(using_postgres):
+    """Build SQLALCHEMY_ENGINE_OPTIONS from DB_* environment variables."""
+    options = {
+        "pool_recycle": _env_int("DB_POOL_RECYCLE", 1800),
+        "pool_pre_ping": _env_bool("DB_POOL_PRE_PING", using_postgres),
+    }
+    if using_postgres:
+        # SQLite keeps the pool Flask-SQLAlchemy picks for it (a StaticPool
+        # for in-memory databases), which takes no sizing arguments.
+        TimedQueuePool.slow_checkout_seconds = _env_int("DB_SLOW_CHECKOUT_MS", 100) / 1000
+        options.update(
+            poolclass=TimedQueuePool,
+            pool_size=_env_int("DB_POOL_SIZE", 5),
+            max_overflow=_env_int("DB_MAX_OVERFLOW", 10),
+            pool_timeout=_env_int("DB_POOL_TIMEOUT", 30),
+        )
+        connect_args = {}
+        statement_timeout = _env_int("DB_STATEMENT_TIMEOUT_MS", 0)
+        if statement_timeout:
+            connect_args["options"] = f"-c statement_timeout={statement_timeout}"
+        # psycopg prepares a statement server-side once it has run this many
+        # times on a connection; "off" disables it (needed behind pgbouncer).
+        prepare_threshold = os.getenv("DB_PREPARE_THRESHOLD")
+        if prepare_threshold:
+            connect_args["prepare_threshold"] = None if prepare_threshold == "off" else int(prepare_threshold)
+        if connect_args:
+            options["connect_args"] = connect_args
+    return options
+
+
+@event.listens_for(Engine, "connect")
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={_env_int('SQLITE_BUSY_TIMEOUT_MS', 5000)}")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
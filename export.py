@@ -0,0 +1,97 @@
+import csv
+import io
+import json
+import zlib
+from datetime import date, datetime
+
+from sqlalchemy import select
+
+from extensions import db
+from models import Habit, HabitEntry, Mood, ToDo
+
+# Rows fetched per round trip. With psycopg, ``yield_per`` also turns on
+# ``stream_results``, so the rows come from a server-side cursor instead of
+# being buffered by the driver.
+EXPORT_BATCH_SIZE = 1000
+
+# Text is handed to the response (and the compressor) in chunks of about
+# this many characters rather than one line at a time.
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# The second column is always the owning user's id.
+EXPORTS = {
+    "moods": (Mood.id, Mood.user_id, Mood.mood, Mood.notes, Mood.created_at),
+    "todos": (ToDo.id, ToDo.user_id, ToDo.task, ToDo.detail, ToDo.done, ToDo.created_at),
+    "habits": (Habit.id, Habit.user_id, Habit.habit, Habit.frequency, Habit.created_at),
+    "habit-entries": (HabitEntry.id, Habit.user_id, HabitEntry.habit_id, HabitEntry.date, HabitEntry.created_at),
+}
+
+FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def export_query(resource, user_id=None):
+    """SELECT the export columns of ``resource`` in id order, optionally for one user."""
+    columns = EXPORTS[resource]
+    stmt = select(*columns)
+    if resource == "habit-entries":
+        stmt = stmt.select_from(HabitEntry).join(Habit, Habit.id == HabitEntry.habit_id)
+    if user_id is not None:
+        stmt = stmt.where(columns[1] == user_id)
+    return stmt.order_by(columns[0])
+
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _csv_lines(names, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _ndjson_lines(names, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(names, row)), default=_json_default) + "\n"
+
+
+def _chunked(lines):
+    chunk, size = [], 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield "".join(chunk)
+
+
+def _gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_export(resource, fmt, user_id=None, compress=False):
+    """Yield ``resource`` encoded as ``fmt`` in bytes chunks, gzip-compressed if asked.
+
+    Rows are read as plain tuples in ``EXPORT_BATCH_SIZE`` batches and
+    encoded as they arrive, so memory use does not grow with the table.
+    """
+    stmt = export_query(resource, user_id)
+    names = [column.key for column in EXPORTS[resource]]
+    rows = db.session.execute(stmt.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    encode = _csv_lines if fmt == "csv" else _ndjson_lines
+    chunks = (text.encode() for text in _chunked(encode(names, rows)))
+    return _gzipped(chunks) if compress else chunks
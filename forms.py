@@ -1,13 +1,15 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired
 from wtforms import (
     BooleanField,
+    IntegerField,
     PasswordField,
     SelectField,
     StringField,
     SubmitField,
     TextAreaField,
 )
-from wtforms.validators import DataRequired, Email, Length
+from wtforms.validators import DataRequired, Email, Length, Optional
 
 MOOD_CHOICES = [
     ('Happy', 'Happy'),
@@ -63,3 +65,19 @@ class TipForm(FlaskForm):
 class AdminUserForm(FlaskForm):
     is_admin = BooleanField('Admin privileges')
     submit = SubmitField('Update role')
+
+
+DATA_CHOICES = [('moods', 'Moods'), ('todos', 'To-dos'), ('habits', 'Habits'), ('habit-entries', 'Habit entries')]
+
+
+class ImportForm(FlaskForm):
+    resource = SelectField('Data', choices=DATA_CHOICES)
+    file = FileField('CSV or NDJSON file (optionally .gz)', validators=[FileRequired()])
+    user_id = IntegerField('Assign every row to user id', validators=[Optional()])
+    submit = SubmitField('Import')
+
+
+class ExportJobForm(FlaskForm):
+    resource = SelectField('Data', choices=DATA_CHOICES)
+    format = SelectField('Format', choices=[('csv', 'CSV'), ('ndjson', 'NDJSON')])
+    submit = SubmitField('Queue export')
@@ -0,0 +1,291 @@
+from datetime import date, datetime
+
+from sqlalchemy import Date, Integer, case, cast, delete, func, literal, select, type_coerce
+
+from dbutil import dialect_name, insert_ignore, upsert
+from extensions import db
+from models import Habit, HabitEntry, HabitStreak
+from replica import use_primary
+from stats import adjust_user_stats
+from sync import record_changes
+
+
+def _insert_entries(owned_habits, day):
+    """INSERT ... SELECT from the user's habits, skipping entries that already exist."""
+    now = datetime.utcnow()
+    return (
+        insert_ignore(HabitEntry, ["habit_id", "date"])
+        .from_select(
+            ["habit_id", "date", "created_at"],
+            select(Habit.id, literal(day, HabitEntry.date.type), literal(now, HabitEntry.created_at.type))
+            .where(owned_habits),
+        )
+        .returning(HabitEntry.id, HabitEntry.habit_id)
+    )
+
+
+def _record(user_id, entry_ids, op):
+    connection = db.session.connection()
+    sign = 1 if op == "upsert" else -1
+    adjust_user_stats(connection, user_id, habit_entries=sign * len(entry_ids))
+    record_changes(connection, user_id, "habit_entries", entry_ids, op)
+
+
+def toggle_habit_entry(user_id, habit_id, day):
+    """Flip a habit's completion for ``day``; the caller commits.
+
+    Returns True when the habit is now completed, False when the entry was
+    removed and None when the habit does not belong to the user. The
+    ownership check lives in each statement's WHERE clause, and the insert
+    uses ON CONFLICT DO NOTHING, so double submits never hit _habit_date_uc.
+    """
+    owned = select(Habit.id).where(Habit.id == habit_id, Habit.user_id == user_id)
+    removed = db.session.scalars(
+        delete(HabitEntry)
+        .where(HabitEntry.habit_id.in_(owned), HabitEntry.date == day)
+        .returning(HabitEntry.id)
+        .execution_options(synchronize_session=False)
+    ).all()
+    if removed:
+        _record(user_id, removed, "delete")
+        update_streaks([habit_id], day, added=False)
+        return False
+
+    added = db.session.execute(_insert_entries((Habit.id == habit_id) & (Habit.user_id == user_id), day)).all()
+    if added:
+        _record(user_id, [row.id for row in added], "upsert")
+        update_streaks([habit_id], day, added=True)
+        return True
+
+    # Nothing inserted: either the habit is not ours, or a concurrent request
+    # completed it between our two statements.
+    return True if db.session.scalar(owned) is not None else None
+
+
+def complete_all_habits(user_id, day):
+    """Mark every habit of the user completed for ``day`` in one statement.
+
+    Returns how many entries were added. The caller commits.
+    """
+    added = db.session.execute(_insert_entries(Habit.user_id == user_id, day)).all()
+    if added:
+        _record(user_id, [row.id for row in added], "upsert")
+        update_streaks([row.habit_id for row in added], day, added=True)
+    return len(added)
+
+
+# Streaks are counted in periods of the habit's frequency: days for Daily
+# (and Custom, which has no schedule of its own), Monday-based weeks for
+# Weekly and calendar months for Monthly. A streak is still current while
+# the previous period is completed and the present one is not over yet.
+
+EPOCH = date(1970, 1, 1)
+
+# How many recent periods the completion rate looks at.
+RATE_WINDOWS = {"Daily": 30, "Weekly": 12, "Monthly": 12}
+
+
+def _window(frequency):
+    return RATE_WINDOWS.get(frequency, RATE_WINDOWS["Daily"])
+
+
+def period_of(day, frequency):
+    """Index of the period ``day`` falls in; consecutive periods differ by one."""
+    days = (day - EPOCH).days
+    if frequency == "Weekly":
+        return (days + 3) // 7  # 1970-01-01 was a Thursday
+    if frequency == "Monthly":
+        return day.year * 12 + day.month - 1
+    return days
+
+
+def _period_column():
+    """SQL twin of :func:`period_of` for ``HabitEntry.date`` and ``Habit.frequency``."""
+    if dialect_name() == "sqlite":
+        days = cast(func.julianday(HabitEntry.date) - 2440587.5, Integer)
+        year = cast(func.strftime("%Y", HabitEntry.date), Integer)
+        month = cast(func.strftime("%m", HabitEntry.date), Integer)
+    else:
+        # date - date is an integer number of days in Postgres.
+        days = type_coerce(HabitEntry.date - literal(EPOCH, Date), Integer)
+        year = cast(func.extract("year", HabitEntry.date), Integer)
+        month = cast(func.extract("month", HabitEntry.date), Integer)
+    return case(
+        (Habit.frequency == "Weekly", (days + 3) // 7),
+        (Habit.frequency == "Monthly", year * 12 + month - 1),
+        else_=days,
+    )
+
+
+def compute_streaks(habit_ids):
+    """Return ``{habit_id: (current_run, last_period, longest)}`` from the entries.
+
+    Gaps and islands: numbering a habit's distinct periods in order and
+    subtracting that from the period gives a value shared by every period of
+    one unbroken run. ``current_run`` is the length of the latest run and
+    ``last_period`` where it ends. Habits without entries are left out.
+    """
+    if not habit_ids:
+        return {}
+    periods = (
+        select(HabitEntry.habit_id, _period_column().label("period"))
+        .join(Habit, Habit.id == HabitEntry.habit_id)
+        .where(HabitEntry.habit_id.in_(habit_ids))
+        .distinct()
+        .cte("periods")
+    )
+    islands = select(
+        periods.c.habit_id,
+        periods.c.period,
+        (periods.c.period - func.row_number().over(partition_by=periods.c.habit_id, order_by=periods.c.period))
+        .label("island"),
+    ).cte("islands")
+    runs = (
+        select(
+            islands.c.habit_id,
+            func.count().label("length"),
+            func.max(islands.c.period).label("last_period"),
+        )
+        .group_by(islands.c.habit_id, islands.c.island)
+        .subquery("runs")
+    )
+    ranked = select(
+        runs,
+        func.row_number().over(partition_by=runs.c.habit_id, order_by=runs.c.last_period.desc()).label("recency"),
+    ).subquery("ranked")
+    stmt = select(
+        ranked.c.habit_id,
+        func.max(case((ranked.c.recency == 1, ranked.c.length))),
+        func.max(ranked.c.last_period),
+        func.max(ranked.c.length),
+    ).group_by(ranked.c.habit_id)
+    return {habit_id: (current, last, longest) for habit_id, current, last, longest in db.session.execute(stmt)}
+
+
+def _cached_streaks(habits):
+    """Load the habit_streaks rows for ``habits``, computing any that are missing or stale."""
+    # Rows are written back, so they are computed from the primary, never a replica.
+    with use_primary():
+        return _load_streaks(habits)
+
+
+def _load_streaks(habits):
+    rows = {row.habit_id: row for row in HabitStreak.query.filter(HabitStreak.habit_id.in_([h.id for h in habits]))}
+    stale = [h for h in habits if h.id not in rows or rows[h.id].frequency != h.frequency]
+    if stale:
+        computed = compute_streaks([h.id for h in stale])
+        now = datetime.utcnow()
+        values = []
+        for h in stale:
+            current, last, longest = computed.get(h.id, (0, None, 0))
+            values.append(dict(habit_id=h.id, frequency=h.frequency, current_run=current,
+                               last_period=last, longest=longest, updated_at=now))
+        # An upsert, as concurrent page loads may compute the same rows.
+        columns = ("frequency", "current_run", "last_period", "longest", "updated_at")
+        db.session.execute(upsert(HabitStreak, ["habit_id"], columns), values)
+        db.session.commit()
+        rows.update((row["habit_id"], HabitStreak(**row)) for row in values)
+    return rows
+
+
+def _current(row, today):
+    if row.last_period is None or row.last_period < period_of(today, row.frequency) - 1:
+        return 0
+    return row.current_run
+
+
+def get_completion_rates(habits, today):
+    """Share of the last ``RATE_WINDOWS`` periods (or fewer, for young habits) completed."""
+    if not habits:
+        return {}
+    period = _period_column()
+    since = case(
+        *((Habit.frequency == frequency, period_of(today, frequency) - window)
+          for frequency, window in RATE_WINDOWS.items()),
+        else_=period_of(today, "Daily") - _window("Daily"),
+    )
+    completed = dict(db.session.execute(
+        select(HabitEntry.habit_id, func.count(period.distinct()))
+        .join(Habit, Habit.id == HabitEntry.habit_id)
+        .where(HabitEntry.habit_id.in_([h.id for h in habits]), period > since, HabitEntry.date <= today)
+        .group_by(HabitEntry.habit_id)
+    ).all())
+    rates = {}
+    for h in habits:
+        now = period_of(today, h.frequency)
+        started = period_of(h.created_at.date(), h.frequency) if h.created_at else now
+        periods = max(1, min(_window(h.frequency), now - started + 1))
+        rates[h.id] = min(1.0, completed.get(h.id, 0) / periods)
+    return rates
+
+
+def get_habit_streaks(habits, today=None, rates=False):
+    """Return ``{habit_id: {"current", "longest"[, "rate"]}}`` for ``habits``."""
+    today = today or date.today()
+    rows = _cached_streaks(habits) if habits else {}
+    completion = get_completion_rates(habits, today) if rates else {}
+    streaks = {}
+    for h in habits:
+        row = rows[h.id]
+        streaks[h.id] = {"current": _current(row, today), "longest": row.longest}
+        if rates:
+            streaks[h.id]["rate"] = completion[h.id]
+    return streaks
+
+
+def best_streak(user_id):
+    """Longest streak any of the user's habits has reached."""
+    rows = db.session.execute(
+        select(Habit.frequency, HabitStreak.frequency, HabitStreak.longest)
+        .outerjoin(HabitStreak, HabitStreak.habit_id == Habit.id)
+        .where(Habit.user_id == user_id)
+    ).all()
+    if all(cached is not None and cached == frequency for frequency, cached, _longest in rows):
+        return max((longest for _frequency, _cached, longest in rows), default=0)
+    habits = Habit.query.filter_by(user_id=user_id).all()
+    return max((s["longest"] for s in get_habit_streaks(habits).values()), default=0)
+
+
+def invalidate_streaks(habit_ids):
+    """Forget cached streaks; they are recomputed on the next read.
+
+    ``habit_ids`` may be a list or a SELECT of habit ids.
+    """
+    db.session.execute(
+        delete(HabitStreak)
+        .where(HabitStreak.habit_id.in_(habit_ids))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def update_streaks(habit_ids, day, added):
+    """Fold one entry added to or removed from ``day`` into the cached streaks.
+
+    Only the end of the latest run can be updated in place. Anything the
+    cached row cannot answer on its own (a removal that may shorten the
+    longest run, or a week/month that might still hold another entry) drops
+    the row instead. Habits without a cached row are skipped. The caller
+    commits.
+    """
+    dropped = []
+    for row in HabitStreak.query.filter(HabitStreak.habit_id.in_(habit_ids)):
+        period = period_of(day, row.frequency)
+        if added:
+            if row.last_period is not None and row.last_period >= period:
+                if row.last_period > period:
+                    dropped.append(row.habit_id)
+                continue
+            row.current_run = row.current_run + 1 if row.last_period == period - 1 else 1
+            row.last_period = period
+            row.longest = max(row.longest, row.current_run)
+        elif (
+            row.last_period == period
+            and row.frequency not in ("Weekly", "Monthly")
+            and 1 < row.current_run < row.longest
+        ):
+            row.current_run -= 1
+            row.last_period = period - 1
+        else:
+            dropped.append(row.habit_id)
+    if dropped:
+        invalidate_streaks(dropped)
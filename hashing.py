@@ -0,0 +1,58 @@
+import threading
+from functools import lru_cache
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+DEFAULT_METHOD = "pbkdf2:sha256:600000"
+DEFAULT_WORKERS = 2
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _config(key, default):
+    try:
+        return current_app.config.get(key, default)
+    except RuntimeError:
+        return default
+
+
+def hash_method():
+    return _config("PASSWORD_HASH_METHOD", DEFAULT_METHOD)
+
+
+def get_executor():
+    """Return the shared hashing pool, sized by PASSWORD_HASH_WORKERS.
+
+    pbkdf2 releases the GIL, so a small thread pool caps how many cores a
+    login burst can take while other requests keep running.
+    """
+    global _executor
+    if _executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+
+        with _executor_lock:
+            if _executor is None:
+                workers = _config("PASSWORD_HASH_WORKERS", DEFAULT_WORKERS)
+                _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pwhash")
+    return _executor
+
+
+def hash_password(password, method=None):
+    return get_executor().submit(generate_password_hash, password, method or hash_method()).result()
+
+
+def verify_password(pwhash, password):
+    return get_executor().submit(check_password_hash, pwhash, password).result()
+
+
+@lru_cache(maxsize=None)
+def _stored_method(method):
+    # werkzeug fills in defaults when it hashes ("scrypt" is stored as
+    # "scrypt:32768:8:1"), so compare against what it actually writes.
+    return hash_password("", method).split("$", 1)[0]
+
+
+def needs_rehash(pwhash, method=None):
+    return pwhash.split("$", 1)[0] != _stored_method(method or hash_method())
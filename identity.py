@@ -0,0 +1,43 @@
+from flask import current_app
+
+from cache import TTLCache
+
+
+class CurrentUser:
+    """The slice of a User row that most requests need."""
+
+    __slots__ = ("id", "username", "is_admin")
+
+    def __init__(self, id, username, is_admin):
+        self.id = id
+        self.username = username
+        self.is_admin = is_admin
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, bool(user.is_admin))
+
+
+class IdentityCache:
+    """Process-local LRU of CurrentUser entries with a TTL.
+
+    Each worker process keeps its own copy, so a role change made in one
+    worker reaches the others once their entries expire.
+    """
+
+    def __init__(self, maxsize=1024):
+        self._entries = TTLCache(maxsize)
+
+    def get(self, user_id):
+        return self._entries.get(user_id)
+
+    def set(self, identity):
+        ttl = current_app.config.get("CURRENT_USER_CACHE_TTL", 60)
+        if ttl > 0:
+            self._entries.set(identity.id, identity, ttl)
+
+    def invalidate(self, user_id):
+        self._entries.delete(user_id)
+
+
+identity_cache = IdentityCache()
@@ -0,0 +1,393 @@
+import csv
+import gzip
+import hashlib
+import io
+import json
+import time
+from collections import defaultdict
+from datetime import date, datetime
+
+from sqlalchemy import insert, select
+
+from dbutil import insert_ignore
+from extensions import db
+from forms import FREQUENCY_CHOICES, MOOD_CHOICES
+from habits import invalidate_streaks
+from jobs import enqueue
+from models import Habit, HabitEntry, ImportRun, Mood, ToDo, User
+from rollups import reopen_days
+from stats import adjust_user_stats
+from sync import record_changes
+
+# Rows written (and checkpointed) per transaction.
+IMPORT_BATCH_SIZE = 1000
+
+# Only the first few invalid rows are reported back; the rest are counted.
+MAX_REPORTED_ERRORS = 20
+
+
+class RowError(ValueError):
+    pass
+
+
+class ImportFileError(ValueError):
+    """The file itself could not be read: bad gzip data, wrong encoding or broken CSV."""
+
+
+# What reading a malformed or mislabelled file raises part-way through.
+_READ_ERRORS = (OSError, EOFError, UnicodeDecodeError, csv.Error)
+
+
+# Field parsers accept both CSV strings and typed NDJSON values.
+
+def _text(max_length=None, required=False):
+    def parse(value):
+        if value is None or value == "":
+            if required:
+                raise RowError("is required")
+            return None
+        value = str(value)
+        if max_length and len(value) > max_length:
+            raise RowError(f"must be at most {max_length} characters")
+        return value
+
+    return parse
+
+
+def _choice(choices, required=False):
+    values = {value for value, _label in choices}
+
+    def parse(value):
+        if value in (None, "") and not required:
+            return None
+        if value not in values:
+            raise RowError("must be one of " + ", ".join(sorted(values)))
+        return value
+
+    return parse
+
+
+def _boolean(value):
+    if isinstance(value, bool):
+        return value
+    text = str(value or "").strip().lower()
+    if text in ("1", "true", "yes", "y"):
+        return True
+    if text in ("", "0", "false", "no", "n"):
+        return False
+    raise RowError("must be true or false")
+
+
+def _integer(value):
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RowError("must be an integer") from None
+
+
+def _datetime(value):
+    if value is None or value == "":
+        return None
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        raise RowError("must be an ISO 8601 datetime") from None
+
+
+def _date(value):
+    try:
+        return date.fromisoformat(str(value)[:10])
+    except ValueError:
+        raise RowError("must be an ISO 8601 date") from None
+
+
+# Per resource: model, field parsers and the user_stats counter.
+# The columns match what ``flask export`` writes, so an export can be loaded
+# back; ``id`` columns are ignored and habit entries may name their habit
+# instead of giving its id.
+IMPORTS = {
+    "moods": {
+        "model": Mood,
+        "fields": {"user_id": _integer, "mood": _choice(MOOD_CHOICES, required=True), "notes": _text(),
+                   "created_at": _datetime},
+        "counter": "moods",
+    },
+    "todos": {
+        "model": ToDo,
+        "fields": {"user_id": _integer, "task": _text(255, required=True), "detail": _text(), "done": _boolean,
+                   "created_at": _datetime},
+        "counter": "todos",
+    },
+    "habits": {
+        "model": Habit,
+        "fields": {"user_id": _integer, "habit": _text(255, required=True), "frequency": _choice(FREQUENCY_CHOICES),
+                   "created_at": _datetime},
+        "counter": "habits",
+    },
+    "habit-entries": {
+        "model": HabitEntry,
+        "fields": {"user_id": _integer, "habit_id": _integer, "habit": _text(255), "date": _date,
+                   "created_at": _datetime},
+        "counter": "habit_entries",
+    },
+}
+
+SYNC_KINDS = {"moods": "moods", "todos": "todos", "habits": "habits", "habit-entries": "habit_entries"}
+
+
+def file_checksum(stream):
+    """SHA-256 of a binary stream, which is rewound afterwards."""
+    digest = hashlib.sha256()
+    for block in iter(lambda: stream.read(1 << 20), b""):
+        digest.update(block)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def detect_format(filename):
+    name = filename.lower().removesuffix(".gz")
+    return "ndjson" if name.endswith((".ndjson", ".jsonl", ".json")) else "csv"
+
+
+def read_rows(stream, fmt, compressed=False):
+    """Yield one dict per record of a binary CSV or NDJSON stream."""
+    if compressed:
+        stream = gzip.GzipFile(fileobj=stream)
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    if fmt == "csv":
+        yield from csv.DictReader(text)
+        return
+    for line in text:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+class ImportResult:
+    """Counters of an import run plus the throughput of this call."""
+
+    __slots__ = ("run", "errors", "rows", "seconds")
+
+    def __init__(self, run, errors):
+        self.run = run
+        self.errors = errors
+        self.rows = 0
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def summary(self):
+        run = self.run
+        if run.finished_at is not None and not self.rows and run.rows_done:
+            return f"already imported on {run.finished_at:%Y-%m-%d %H:%M} ({run.rows_done} rows)"
+        return (
+            f"{run.rows_done} rows: {run.rows_inserted} inserted, {run.rows_skipped} duplicates, "
+            f"{run.rows_invalid} invalid ({self.rows_per_second:,.0f} rows/s)"
+        )
+
+
+class _Importer:
+    def __init__(self, resource, run, user_id=None):
+        self.spec = IMPORTS[resource]
+        self.resource = resource
+        self.run = run
+        self.user_id = user_id
+        self.errors = []
+        self.owners = {}
+        self.earliest = None
+
+    def invalid(self, number, message):
+        self.run.rows_invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f"row {number}: {message}")
+
+    def clean(self, number, raw):
+        if not isinstance(raw, dict):
+            self.invalid(number, "is not a JSON object")
+            return None
+        row = {}
+        try:
+            for name, parse in self.spec["fields"].items():
+                try:
+                    row[name] = parse(raw.get(name))
+                except RowError as error:
+                    raise RowError(f"{name} {error}") from None
+        except RowError as error:
+            self.invalid(number, str(error))
+            return None
+        if self.user_id is not None:
+            row["user_id"] = self.user_id
+        row["created_at"] = row["created_at"] or datetime.utcnow()
+        return number, row
+
+    def write(self, batch):
+        """Insert one batch of cleaned rows; the caller checkpoints and commits."""
+        if self.spec["model"] is HabitEntry:
+            rows = self._resolve_habits(batch)
+        else:
+            rows = self._known_users(batch)
+        inserted = self._insert(rows) if rows else []
+        if inserted:
+            # Imported history lands on days the daily rollups may already
+            # have closed; those are counted again from the raw rows.
+            earliest = min(row["date"] if "date" in row else row["created_at"].date() for row in rows)
+            if self.earliest is None or earliest < self.earliest:
+                self.earliest = earliest
+                reopen_days(earliest)
+        self.run.rows_inserted += len(inserted)
+        self.run.rows_skipped += len(rows) - len(inserted)
+
+    def _known_users(self, batch):
+        user_ids = {row["user_id"] for _number, row in batch if row["user_id"] is not None}
+        known = set(db.session.scalars(select(User.id).where(User.id.in_(user_ids)))) if user_ids else set()
+        rows = []
+        for number, row in batch:
+            if row["user_id"] not in known:
+                self.invalid(number, "user_id does not match a user")
+            else:
+                rows.append(row)
+        return rows
+
+    def _resolve_habits(self, batch):
+        """Map entries to (habit_id, date) of habits owned by their user, dropping duplicates."""
+        ids = {row["habit_id"] for _number, row in batch if row["habit_id"] is not None}
+        names = {row["habit"] for _number, row in batch if row["habit_id"] is None and row["habit"]}
+        by_id, by_name = {}, {}
+        if ids:
+            by_id = dict(db.session.execute(select(Habit.id, Habit.user_id).where(Habit.id.in_(ids))).all())
+        if names:
+            users = {row["user_id"] for _number, row in batch if row["habit_id"] is None}
+            for habit_id, user_id, name in db.session.execute(
+                select(Habit.id, Habit.user_id, Habit.habit)
+                .where(Habit.habit.in_(names), Habit.user_id.in_(users))
+                .order_by(Habit.id)
+            ):
+                by_name.setdefault((user_id, name), habit_id)
+
+        rows, seen = [], set()
+        for number, row in batch:
+            if row["habit_id"] is not None:
+                habit_id = row["habit_id"]
+                owner = by_id.get(habit_id)
+                if owner is None or row["user_id"] not in (None, owner):
+                    self.invalid(number, "habit_id does not match a habit of this user")
+                    continue
+            else:
+                habit_id = by_name.get((row["user_id"], row["habit"]))
+                if habit_id is None:
+                    self.invalid(number, "needs habit_id, or user_id and the name of an existing habit")
+                    continue
+                owner = row["user_id"]
+            key = (habit_id, row["date"])
+            if key in seen:
+                self.run.rows_skipped += 1
+                continue
+            seen.add(key)
+            self.owners[habit_id] = owner
+            rows.append({"habit_id": habit_id, "date": row["date"], "created_at": row["created_at"]})
+        return rows
+
+    def _insert(self, rows):
+        model = self.spec["model"]
+        if model is HabitEntry:
+            # Entries already in the table are skipped by _habit_date_uc.
+            stmt = insert_ignore(HabitEntry, ["habit_id", "date"]).returning(HabitEntry.id, HabitEntry.habit_id)
+        else:
+            rows = [{k: v for k, v in row.items() if k in model.__table__.c} for row in rows]
+            extra = (ToDo.done,) if model is ToDo else ()
+            stmt = insert(model).returning(model.id, model.user_id, *extra)
+        inserted = db.session.execute(stmt, rows).all()
+
+        per_user = defaultdict(list)
+        done = defaultdict(int)
+        for row in inserted:
+            user_id = self.owners[row.habit_id] if model is HabitEntry else row.user_id
+            per_user[user_id].append(row.id)
+            if model is ToDo and row.done:
+                done[user_id] += 1
+        connection = db.session.connection()
+        for user_id, ids in per_user.items():
+            deltas = {self.spec["counter"]: len(ids)}
+            if model is ToDo:
+                deltas["todos_done"] = done[user_id]
+            adjust_user_stats(connection, user_id, **deltas)
+            record_changes(connection, user_id, SYNC_KINDS[self.resource], ids, "upsert")
+        if model is HabitEntry and inserted:
+            invalidate_streaks({row.habit_id for row in inserted})
+        return inserted
+
+
+def run_import(resource, rows, checksum, source=None, user_id=None, batch_size=None, progress=None):
+    """Load ``rows`` (dicts from :func:`read_rows`) into ``resource`` in batches.
+
+    Each batch is written with one executemany INSERT and committed together
+    with the run's checkpoint. Importing a file with the same ``checksum``
+    again resumes an unfinished run after its last committed batch and does
+    nothing for a finished one. Invalid
+    rows are counted and skipped. ``user_id`` assigns every row to one user.
+    ``progress`` is called with the ImportResult after each batch. A file
+    that cannot be read raises :class:`ImportFileError`, after recording
+    the reason on the run.
+    """
+    batch_size = batch_size or IMPORT_BATCH_SIZE
+    run = (
+        ImportRun.query.filter_by(resource=resource, checksum=checksum)
+        .order_by(ImportRun.id.desc())
+        .first()
+    )
+    if run is not None and run.finished_at is not None:
+        # Already loaded; loading it again would only duplicate rows.
+        return ImportResult(run, [])
+    if run is None:
+        run = ImportRun(resource=resource, source=source, checksum=checksum,
+                        rows_done=0, rows_inserted=0, rows_skipped=0, rows_invalid=0)
+        db.session.add(run)
+        db.session.commit()
+    importer = _Importer(resource, run, user_id)
+    result = ImportResult(run, importer.errors)
+    resume_after = run.rows_done
+    started = time.perf_counter()
+
+    batch = []
+    number = resume_after
+    try:
+        for number, raw in enumerate(rows, 1):
+            if number <= resume_after:
+                continue
+            cleaned = importer.clean(number, raw)
+            if cleaned:
+                batch.append(cleaned)
+            if number - run.rows_done >= batch_size:
+                importer.write(batch)
+                run.rows_done = number
+                db.session.commit()
+                batch = []
+                result.rows = number - resume_after
+                result.seconds = time.perf_counter() - started
+                if progress:
+                    progress(result)
+    except _READ_ERRORS as error:
+        # Batches already committed stay; the run is left unfinished with
+        # the reason, and the pending batch is dropped.
+        db.session.rollback()
+        run.error = f"Unreadable after row {run.rows_done}: {type(error).__name__}: {error}"
+        db.session.commit()
+        raise ImportFileError(run.error) from error
+    if batch:
+        importer.write(batch)
+    if importer.earliest is not None:
+        enqueue("rollup", {"days_back": 0}, dedupe=True)
+    run.rows_done = max(number, run.rows_done)
+    run.finished_at = datetime.utcnow()
+    run.error = None
+    db.session.commit()
+
+    result.rows = run.rows_done - resume_after
+    result.seconds = time.perf_counter() - started
+    return result
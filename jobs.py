@@ -0,0 +1,321 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import delete, func, select, update
+
+from badges import sync_badges
+from extensions import db
+from habits import get_habit_streaks
+from models import Habit, ImportRun, Job, SyncChange
+from rollups import close_days, reopen_days
+from stats import rebuild_user_stats
+
+logger = logging.getLogger(__name__)
+
+JOB_STATUSES = ("queued", "running", "done", "failed")
+
+# Longest wait before a failed job is retried, however many attempts it took.
+MAX_RETRY_DELAY = 3600
+
+# kind -> function called with the job's payload as keyword arguments.
+handlers = {}
+
+
+def handler(kind):
+    """Register the decorated function as the handler of ``kind`` jobs.
+
+    Handlers run inside the worker's app context and session. Their writes
+    are committed together with the job's "done" status, so they should not
+    commit themselves unless they work in batches, and must be safe to run
+    twice: a job whose lease expires is handed to another worker. The return
+    value, if any, is stored as the job's result.
+    """
+
+    def register(func):
+        handlers[kind] = func
+        return func
+
+    return register
+
+
+def enqueue(kind, payload=None, delay=0, max_attempts=None, dedupe=False):
+    """Add a job to the caller's transaction; it is visible once the caller commits.
+
+    With ``dedupe`` an identical job that is still queued is reused, so a
+    burst of requests asking for the same work only queues it once.
+    """
+    if kind not in handlers:
+        raise ValueError(f"Unknown job kind {kind!r}")
+    body = json.dumps(payload or {}, sort_keys=True)
+    if dedupe:
+        existing = db.session.scalar(
+            select(Job).where(Job.kind == kind, Job.payload == body, Job.status == "queued").limit(1)
+        )
+        if existing is not None:
+            return existing
+    job = Job(
+        kind=kind,
+        payload=body,
+        status="queued",
+        attempts=0,
+        max_attempts=max_attempts or current_app.config["JOB_MAX_ATTEMPTS"],
+        run_at=datetime.utcnow() + timedelta(seconds=delay),
+    )
+    db.session.add(job)
+    return job
+
+
+def claim(worker_id, visibility_timeout):
+    """Lease the next due job to ``worker_id`` and return its id, or None.
+
+    A job is due when it is queued and its ``run_at`` has passed, or when it
+    is running but its lease has expired (the worker died or hung). One
+    UPDATE picks and leases the job; on Postgres the row is chosen with
+    ``FOR UPDATE SKIP LOCKED`` so concurrent workers never wait on each
+    other, and SQLite serialises writers anyway.
+    """
+    now = datetime.utcnow()
+    candidate = (
+        select(Job.id)
+        .where(Job.status.in_(("queued", "running")), Job.run_at <= now, Job.attempts < Job.max_attempts)
+        .order_by(Job.run_at, Job.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    job_id = db.session.scalar(
+        update(Job)
+        .where(Job.id == candidate)
+        .values(
+            status="running",
+            attempts=Job.attempts + 1,
+            run_at=now + timedelta(seconds=visibility_timeout),
+            locked_by=worker_id,
+        )
+        .returning(Job.id)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return job_id
+
+
+def fail_expired():
+    """Give up on running jobs whose last allowed attempt ran out of time."""
+    now = datetime.utcnow()
+    expired = db.session.execute(
+        update(Job)
+        .where(Job.status == "running", Job.run_at <= now, Job.attempts >= Job.max_attempts)
+        .values(status="failed", last_error="Lease expired on the last attempt", finished_at=now)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return expired
+
+
+def retry_delay(attempts):
+    return min(current_app.config["JOB_RETRY_DELAY"] * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+def run_job(job_id, worker_id):
+    """Run a leased job and record the outcome. Returns True on success."""
+    job = db.session.get(Job, job_id)
+    kind, payload, attempts, max_attempts = job.kind, job.payload, job.attempts, job.max_attempts
+    # Outcomes are only written while this worker still holds the lease.
+    leased = (Job.id == job_id, Job.locked_by == worker_id, Job.attempts == attempts)
+    started = time.perf_counter()
+    try:
+        func = handlers.get(kind)
+        if func is None:
+            raise LookupError(f"No handler for job kind {kind!r}")
+        result = func(**json.loads(payload))
+    except Exception as error:
+        db.session.rollback()
+        logger.exception("Job %s (%s) failed on attempt %d/%d", job_id, kind, attempts, max_attempts)
+        now = datetime.utcnow()
+        if attempts >= max_attempts:
+            values = dict(status="failed", finished_at=now)
+        else:
+            values = dict(status="queued", run_at=now + timedelta(seconds=retry_delay(attempts)))
+        db.session.execute(
+            update(Job).where(*leased).values(last_error=f"{type(error).__name__}: {error}", locked_by=None, **values)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        return False
+
+    done = db.session.execute(
+        update(Job)
+        .where(*leased)
+        .values(status="done", result=None if result is None else str(result), finished_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    if not done:
+        logger.warning("Job %s (%s) finished after its lease was taken over", job_id, kind)
+    logger.info("Job %s (%s) done in %.2fs", job_id, kind, time.perf_counter() - started)
+    return True
+
+
+class Worker:
+    """Polls the jobs table and runs due jobs one at a time."""
+
+    def __init__(self, app, worker_id=None, poll_interval=None, visibility_timeout=None):
+        self.app = app
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.poll_interval = poll_interval or app.config["JOB_POLL_INTERVAL"]
+        self.visibility_timeout = visibility_timeout or app.config["JOB_VISIBILITY_TIMEOUT"]
+        self._stop = threading.Event()
+
+    def stop(self):
+        """Finish the job in hand, then return from :meth:`run`."""
+        self._stop.set()
+
+    def run(self, burst=False):
+        """Process jobs until stopped; with ``burst``, until none are due. Returns jobs run."""
+        processed = 0
+        checked_expired = 0.0
+        while not self._stop.is_set():
+            with self.app.app_context():
+                if time.monotonic() - checked_expired > self.poll_interval * 60:
+                    fail_expired()
+                    checked_expired = time.monotonic()
+                job_id = claim(self.worker_id, self.visibility_timeout)
+                if job_id is not None:
+                    run_job(job_id, self.worker_id)
+                    processed += 1
+                db.session.remove()
+            if job_id is None:
+                if burst:
+                    break
+                self._stop.wait(self.poll_interval)
+        return processed
+
+
+def init_jobs(app):
+    """With ``JOB_WORKER_THREAD``, run a worker thread in every web process.
+
+    Meant for single-process setups without ``flask worker``. The thread is
+    started on the first request, after any server fork, so CLI commands
+    never start one.
+    """
+    if not app.config.get("JOB_WORKER_THREAD"):
+        return
+    lock = threading.Lock()
+    started = []
+
+    @app.before_request
+    def start_worker_thread():
+        if started:
+            return
+        with lock:
+            if not started:
+                worker = Worker(app, worker_id=f"{socket.gethostname()}:{os.getpid()}:thread")
+                threading.Thread(target=worker.run, name="job-worker", daemon=True).start()
+                started.append(worker)
+
+
+def job_counts():
+    """``{status: count}`` over the whole jobs table, from one query."""
+    counts = dict.fromkeys(JOB_STATUSES, 0)
+    counts.update(db.session.execute(select(Job.status, func.count()).group_by(Job.status)).all())
+    return counts
+
+
+# Deferred work that used to run inside requests.
+
+@handler("sync_badges")
+def _sync_badges(user_ids=None):
+    return f"{len(sync_badges(user_ids))} badge(s) unlocked"
+
+
+@handler("rebuild_stats")
+def _rebuild_stats():
+    return f"{len(rebuild_user_stats(fix=True))} drifted row(s) fixed"
+
+
+@handler("refresh_streaks")
+def _refresh_streaks(user_id):
+    # Recomputes the habit_streaks rows dropped by writes, before the user's
+    # next page view has to.
+    get_habit_streaks(Habit.query.filter_by(user_id=user_id).all())
+
+
+@handler("rollup")
+def _rollup(days_back=None):
+    # Recent days are counted again on every run, so late edits (a task
+    # ticked off after midnight, an entry for yesterday) reach the rollup.
+    if days_back is None:
+        days_back = current_app.config["ROLLUP_REOPEN_DAYS"]
+    if days_back:
+        reopen_days(datetime.utcnow().date() - timedelta(days=days_back))
+        db.session.commit()
+    return f"{close_days()} day(s) closed"
+
+
+@handler("export")
+def _export(resource, fmt="csv", user_id=None, compress=True):
+    from export import EXPORTS, FORMATS, stream_export
+
+    if resource not in EXPORTS or fmt not in FORMATS:
+        raise ValueError(f"Cannot export {resource!r} as {fmt!r}")
+    directory = current_app.config["EXPORT_DIR"]
+    os.makedirs(directory, exist_ok=True)
+    name = f"{resource}-{datetime.utcnow():%Y%m%d-%H%M%S}.{fmt}" + (".gz" if compress else "")
+    path = os.path.join(directory, name)
+    # Written under a temporary name so a download never sees half a file.
+    with open(path + ".part", "wb") as output:
+        for chunk in stream_export(resource, fmt, user_id, compress):
+            output.write(chunk)
+    os.replace(path + ".part", path)
+    return path
+
+
+@handler("cleanup")
+def _cleanup(days=None):
+    """Drop old finished jobs and exports, change-log rows and import runs.
+
+    Jobs and export files go after ``JOB_RETENTION_DAYS``, the sync change
+    log after ``SYNC_RETENTION_DAYS`` and import runs after
+    ``IMPORT_RETENTION_DAYS``.
+    """
+    now = datetime.utcnow()
+    cutoff = now - timedelta(days=days or current_app.config["JOB_RETENTION_DAYS"])
+    exports = db.session.scalars(
+        select(Job.result).where(Job.kind == "export", Job.status == "done", Job.finished_at < cutoff)
+    ).all()
+    for path in exports:
+        if path and os.path.exists(path):
+            os.remove(path)
+    removed = db.session.execute(
+        delete(Job).where(Job.status.in_(("done", "failed")), Job.finished_at < cutoff)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+    # The newest expired row is kept: the first id left in the log tells
+    # /sync which cursors are too old and need a full sync.
+    sync_cutoff = now - timedelta(days=current_app.config["SYNC_RETENTION_DAYS"])
+    newest_expired = db.session.scalar(select(func.max(SyncChange.id)).where(SyncChange.created_at < sync_cutoff))
+    changes = 0
+    if newest_expired is not None:
+        changes = db.session.execute(
+            delete(SyncChange).where(SyncChange.id < newest_expired).execution_options(synchronize_session=False)
+        ).rowcount
+
+    # Finished runs stop a re-upload of the same file from loading it twice;
+    # past the retention window that file is imported again.
+    import_cutoff = now - timedelta(days=current_app.config["IMPORT_RETENTION_DAYS"])
+    runs = db.session.execute(
+        delete(ImportRun)
+        .where(func.coalesce(ImportRun.finished_at, ImportRun.started_at) < import_cutoff)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    return (
+        f"{removed} job(s), {len(exports)} export(s), {changes} change-log row(s) "
+        f"and {runs} import run(s) removed"
+    )
@@ -0,0 +1,302 @@
+import logging
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import DateTime, bindparam, func, select, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from dbutil import create_index_online, dialect_name, index_ddl, insert_ignore
+from extensions import db
+from models import (
+    DailyActivity,
+    DailyUserActivity,
+    Habit,
+    HabitEntry,
+    HabitStreak,
+    ImportRun,
+    Job,
+    Mood,
+    SchemaMigration,
+    SyncChange,
+    Tip,
+    ToDo,
+    User,
+    UserBadge,
+    UserStats,
+)
+from rollups import closed_through, reopen_days
+from search import ensure_search_index
+
+logger = logging.getLogger(__name__)
+
+# Postgres advisory lock held while migrating, so two deploys starting at
+# once apply the migrations one after the other.
+MIGRATION_LOCK_KEY = 7_303_025
+
+# Every table, parents before children.
+MODELS = (
+    User, Tip, Mood, ToDo, Habit, HabitEntry, HabitStreak, UserStats, UserBadge,
+    SyncChange, ImportRun, Job, DailyUserActivity, DailyActivity,
+)
+
+Migration = namedtuple("Migration", "version name upgrade")
+
+# Registered migrations, in version order.
+migrations = []
+
+
+def migration(version, name):
+    """Register the decorated function as schema migration ``version``.
+
+    Migrations run in version order, each exactly once per database, and are
+    never edited once released: later changes get a new version. A version
+    is recorded only after its migration finished, and DDL is not
+    transactional everywhere (SQLite commits it immediately, concurrent index
+    builds run outside any transaction), so a migration must be safe to run
+    again after failing halfway. The helpers below all are.
+    """
+
+    def register(func):
+        if migrations and version <= migrations[-1].version:
+            raise ValueError(f"Migration {version} registered after {migrations[-1].version}")
+        migrations.append(Migration(version, name, func))
+        return func
+
+    return register
+
+
+def head_version():
+    """The version the code expects the database to be at."""
+    return migrations[-1].version
+
+
+def current_version():
+    """The highest migration applied to the primary database, or 0 if none has been."""
+    with db.engine.connect() as connection:
+        try:
+            return connection.scalar(select(func.max(SchemaMigration.version))) or 0
+        except (OperationalError, ProgrammingError):
+            return 0
+
+
+def applied_versions():
+    """``{version: applied_at}`` for every migration applied to the database."""
+    if not db.inspect(db.engine).has_table(SchemaMigration.__tablename__):
+        return {}
+    return dict(db.session.execute(select(SchemaMigration.version, SchemaMigration.applied_at)).all())
+
+
+@contextmanager
+def _migration_lock():
+    if dialect_name() != "postgresql":
+        # SQLite lets one writer in at a time, and every migration tolerates
+        # being run twice.
+        yield
+        return
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+
+
+def migrate(progress=None):
+    """Apply every pending migration in order and return the versions applied.
+
+    ``progress`` is called with each :class:`Migration` before it runs.
+    """
+    applied = []
+    with _migration_lock():
+        SchemaMigration.__table__.create(db.engine, checkfirst=True)
+        done = set(applied_versions())
+        for step in migrations:
+            if step.version in done:
+                continue
+            if progress:
+                progress(step)
+            started = time.perf_counter()
+            try:
+                step.upgrade()
+                db.session.execute(
+                    insert_ignore(SchemaMigration, ["version"])
+                    .values(version=step.version, name=step.name, applied_at=datetime.utcnow())
+                )
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            logger.info("Migration %d (%s) applied in %.2fs", step.version, step.name, time.perf_counter() - started)
+            applied.append(step.version)
+    return applied
+
+
+def init_migrations(app):
+    """Answer 503 while the database is behind the migrations this code expects.
+
+    Processes only compare version numbers, once and then until the database
+    catches up; the schema itself is changed by ``flask migrate`` alone. A
+    database ahead of the code is fine, so old processes keep serving while a
+    deploy migrates.
+    """
+    ready = []
+
+    @app.before_request
+    def check_schema_version():
+        if ready:
+            return None
+        version, head = current_version(), head_version()
+        if version >= head:
+            ready.append(version)
+            return None
+        logger.error("Database schema is at version %d, this code needs %d: run flask migrate", version, head)
+        return "The database is being upgraded. Please try again shortly.", 503
+
+
+# Helpers for migrations.
+
+def _lock_timeout():
+    # DDL waits for a table lock behind running transactions, and every query
+    # on the table queues behind the DDL; give up early instead of stalling them.
+    if dialect_name() == "postgresql":
+        db.session.execute(text(f"SET LOCAL lock_timeout = {int(current_app.config['MIGRATION_LOCK_TIMEOUT_MS'])}"))
+
+
+def create_tables(*models):
+    """Create the models' tables (with their indexes) unless they exist."""
+    for model in models:
+        model.__table__.create(db.session.connection(), checkfirst=True)
+
+
+def add_column(column, definition=None):
+    """Add a model's column to its table unless it is there already.
+
+    ``definition`` defaults to the column's type, nullable. A constant
+    ``DEFAULT`` is fine on big tables: neither database rewrites the rows.
+    """
+    table = column.table.name
+    definition = definition or column.type.compile(dialect=db.engine.dialect)
+    if dialect_name() == "postgresql":
+        _lock_timeout()
+        db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column.name} {definition}"))
+        return
+    existing = {row[1] for row in db.session.execute(text(f"PRAGMA table_info({table})"))}
+    if column.name not in existing:
+        db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column.name} {definition}"))
+
+
+def widen_column(column):
+    """Change a column to its model's longer type.
+
+    SQLite does not enforce ``VARCHAR`` lengths, so only Postgres needs it;
+    there lengthening a ``VARCHAR`` rewrites neither the table nor its indexes.
+    """
+    if dialect_name() != "postgresql":
+        return
+    _lock_timeout()
+    definition = column.type.compile(dialect=db.engine.dialect)
+    db.session.execute(text(f"ALTER TABLE {column.table.name} ALTER COLUMN {column.name} TYPE {definition}"))
+
+
+def create_indexes(*models):
+    """Build the models' declared indexes that are missing, without blocking writes."""
+    for model in models:
+        for index in sorted(model.__table__.indexes, key=lambda index: index.name):
+            create_index_online(index.name, index_ddl(index))
+
+
+def backfill(key, apply, where=(), batch_size=None):
+    """Call ``apply(first, last)`` for consecutive ranges of ``key`` over the rows matching ``where``.
+
+    Each range holds at most ``MIGRATION_BATCH_SIZE`` rows and is committed
+    on its own, so rows are locked a batch at a time and readers never wait
+    long. ``apply`` must repeat the ``where`` filter; a rerun after a failure
+    then skips the rows already done. Returns the number of rows visited.
+    """
+    batch_size = batch_size or current_app.config["MIGRATION_BATCH_SIZE"]
+    after, visited = None, 0
+    while True:
+        stmt = select(key).where(*where).order_by(key).limit(batch_size)
+        if after is not None:
+            stmt = stmt.where(key > after)
+        keys = db.session.scalars(stmt).all()
+        if not keys:
+            return visited
+        apply(keys[0], keys[-1])
+        db.session.commit()
+        visited += len(keys)
+        after = keys[-1]
+
+
+# Migrations. Version 1 creates a new database outright; older databases,
+# set up before migrations existed, get whatever they lack from each step.
+
+@migration(1, "create_tables")
+def _create_tables():
+    # Tables come from the current models, so a migration that later adds a
+    # column must use add_column, which skips columns that already exist.
+    create_tables(*MODELS)
+
+
+@migration(2, "users_admin_columns")
+def _users_admin_columns():
+    # Databases from before admin accounts, formerly patched on every boot
+    # by ensure_schema() and only on SQLite.
+    add_column(User.__table__.c.is_admin, "BOOLEAN NOT NULL DEFAULT FALSE")
+    add_column(User.__table__.c.created_at)
+
+
+@migration(3, "query_indexes")
+def _query_indexes():
+    # Indexes declared after their tables existed; create_all() never adds them.
+    create_indexes(*MODELS)
+
+
+@migration(4, "tip_search_index")
+def _tip_search_index():
+    ensure_search_index()
+
+
+_FIRST_SEEN = text(
+    "UPDATE users SET created_at = coalesce(("
+    "SELECT min(created_at) FROM ("
+    "SELECT created_at FROM moods WHERE user_id = users.id "
+    "UNION ALL SELECT created_at FROM todos WHERE user_id = users.id "
+    "UNION ALL SELECT created_at FROM habits WHERE user_id = users.id"
+    ") AS activity), :now) "
+    "WHERE id BETWEEN :first AND :last AND created_at IS NULL "
+    "RETURNING created_at"
+).bindparams(bindparam("now", type_=DateTime)).columns(created_at=DateTime)
+
+
+@migration(5, "backfill_users_created_at")
+def _backfill_users_created_at():
+    # Users from before the column have no signup time; use their first
+    # recorded activity, or the migration time for users without any.
+    earliest = []
+    now = datetime.utcnow()
+
+    def apply(first, last):
+        filled = db.session.scalars(_FIRST_SEEN, {"now": now, "first": first, "last": last}).all()
+        if filled:
+            earliest.append(min(filled).date())
+
+    backfill(User.id, apply, where=(User.created_at.is_(None),))
+    # The new signup dates may fall on days the rollups already closed.
+    closed = closed_through()
+    if earliest and closed is not None and min(earliest) <= closed:
+        reopen_days(min(earliest))
+
+
+@migration(6, "import_runs_error")
+def _import_runs_error():
+    add_column(ImportRun.__table__.c.error)
+
+
+@migration(7, "widen_password_hash")
+def _widen_password_hash():
+    # 128 characters is too short for scrypt hashes (PASSWORD_HASH_METHOD).
+    widen_column(User.__table__.c.password_hash)
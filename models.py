@@ -1,7 +1,7 @@
 from datetime import datetime, date
 
 from extensions import db
-from werkzeug.security import check_password_hash, generate_password_hash
+from hashing import hash_password, needs_rehash, verify_password
 
 
 class User(db.Model):
@@ -9,7 +9,7 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(128), nullable=False)
+    password_hash = db.Column(db.String(255), nullable=False)
     is_admin = db.Column(db.Boolean, default=False, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
@@ -17,12 +17,63 @@ class User(db.Model):
     todos = db.relationship('ToDo', backref='user', lazy=True, cascade="all, delete-orphan")
     habits = db.relationship('Habit', backref='user', lazy=True, cascade="all, delete-orphan")
     tips = db.relationship('Tip', backref='author', lazy=True)
+    stats = db.relationship('UserStats', uselist=False, lazy=True, cascade="all, delete-orphan")
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return needs_rehash(self.password_hash)
+
+
+class UserStats(db.Model):
+    __tablename__ = 'user_stats'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    moods = db.Column(db.Integer, default=0, nullable=False)
+    todos = db.Column(db.Integer, default=0, nullable=False)
+    todos_done = db.Column(db.Integer, default=0, nullable=False)
+    habits = db.Column(db.Integer, default=0, nullable=False)
+    habit_entries = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    COUNTERS = ('moods', 'todos', 'todos_done', 'habits', 'habit_entries')
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.COUNTERS}
+
+
+# Per-user and site-wide activity of closed (UTC) days, written by rollups.py.
+class DailyUserActivity(db.Model):
+    __tablename__ = 'daily_user_activity'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    moods = db.Column(db.Integer, default=0, nullable=False)
+    todos_done = db.Column(db.Integer, default=0, nullable=False)
+    habit_entries = db.Column(db.Integer, default=0, nullable=False)
+
+
+class DailyActivity(db.Model):
+    __tablename__ = 'daily_activity'
+    # Days without activity get a row too, so the latest row marks how far
+    # the rollups are closed.
+    day = db.Column(db.Date, primary_key=True)
+    active_users = db.Column(db.Integer, default=0, nullable=False)
+    signups = db.Column(db.Integer, default=0, nullable=False)
+    moods = db.Column(db.Integer, default=0, nullable=False)
+    todos_done = db.Column(db.Integer, default=0, nullable=False)
+    habit_entries = db.Column(db.Integer, default=0, nullable=False)
+
+
+class UserBadge(db.Model):
+    __tablename__ = 'user_badges'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    badge_id = db.Column(db.String(64), primary_key=True)
+    unlocked_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (db.Index('ix_user_badges_unlocked', unlocked_at.desc()),)
 
 
 class Mood(db.Model):
@@ -33,6 +84,11 @@ class Mood(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_moods_user_created', 'user_id', created_at.desc()),
+        db.Index('ix_moods_created', 'created_at'),
+    )
+
 
 class ToDo(db.Model):
     __tablename__ = 'todos'
@@ -43,6 +99,12 @@ class ToDo(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_todos_user_created', 'user_id', created_at.desc()),
+        db.Index('ix_todos_user_done', 'user_id', 'done'),
+        db.Index('ix_todos_created', 'created_at'),
+    )
+
 
 class Habit(db.Model):
     __tablename__ = 'habits'
@@ -53,6 +115,9 @@ class Habit(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
 
     entries = db.relationship('HabitEntry', backref='habit', lazy=True, cascade="all, delete-orphan")
+    streak = db.relationship('HabitStreak', uselist=False, lazy=True, cascade="all, delete-orphan")
+
+    __table_args__ = (db.Index('ix_habits_user_created', 'user_id', created_at.desc()),)
 
 
 class HabitEntry(db.Model):
@@ -62,7 +127,20 @@ class HabitEntry(db.Model):
     date = db.Column(db.Date, nullable=False, default=date.today)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    __table_args__ = (db.UniqueConstraint('habit_id', 'date', name='_habit_date_uc'),)
+    __table_args__ = (
+        db.UniqueConstraint('habit_id', 'date', name='_habit_date_uc'),
+        db.Index('ix_habit_entries_date_habit', 'date', 'habit_id'),
+    )
+
+
+class HabitStreak(db.Model):
+    __tablename__ = 'habit_streaks'
+    habit_id = db.Column(db.Integer, db.ForeignKey('habits.id'), primary_key=True)
+    frequency = db.Column(db.String(64))
+    current_run = db.Column(db.Integer, default=0, nullable=False)
+    last_period = db.Column(db.Integer)
+    longest = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
 class Tip(db.Model):
@@ -75,3 +153,67 @@ class Tip(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+
+    __table_args__ = (db.Index('ix_tips_created', created_at.desc()),)
+
+
+class SyncChange(db.Model):
+    __tablename__ = 'sync_changes'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    kind = db.Column(db.String(32), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(8), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_sync_changes_user_seq', 'user_id', 'id'),)
+
+
+class ImportRun(db.Model):
+    __tablename__ = 'import_runs'
+    id = db.Column(db.Integer, primary_key=True)
+    resource = db.Column(db.String(32), nullable=False)
+    source = db.Column(db.String(255))
+    checksum = db.Column(db.String(64), nullable=False)
+    rows_done = db.Column(db.Integer, default=0, nullable=False)
+    rows_inserted = db.Column(db.Integer, default=0, nullable=False)
+    rows_skipped = db.Column(db.Integer, default=0, nullable=False)
+    rows_invalid = db.Column(db.Integer, default=0, nullable=False)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    # Why the file stopped being readable, for runs left unfinished.
+    error = db.Column(db.Text)
+
+    __table_args__ = (db.Index('ix_import_runs_checksum', 'checksum', 'resource'),)
+
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(16), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    # Queued: when the job becomes due. Running: when its lease expires and
+    # another worker may take it over.
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(64))
+    last_error = db.Column(db.Text)
+    result = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_jobs_due', 'status', 'run_at'),
+        db.Index('ix_jobs_created', 'created_at', 'id'),
+    )
+
+
+# One row per migration applied by migrations.py.
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(120), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
@@ -0,0 +1,243 @@
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import Response, abort, current_app, g, has_request_context, request
+from flask.signals import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from cache import fragment_cache
+from engine import pool_metrics
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the request duration histogram.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class RequestProfile:
+    """Timings and queries of the request being served."""
+
+    __slots__ = ("started", "db_time", "template_time", "queries", "statements", "_query_started", "_templates")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.queries = 0
+        self.statements = Counter()
+        self._query_started = []
+        self._templates = []
+
+
+class EndpointStats:
+    __slots__ = ("requests", "wall", "db", "template", "queries", "n_plus_one", "buckets")
+
+    def __init__(self):
+        self.requests = 0
+        self.wall = 0.0
+        self.db = 0.0
+        self.template = 0.0
+        self.queries = 0
+        self.n_plus_one = 0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+
+
+class ProfileRegistry:
+    """Per-endpoint totals collected since the process started."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = defaultdict(EndpointStats)
+
+    def record(self, endpoint, wall, profile, repeated):
+        with self._lock:
+            stats = self._endpoints[endpoint]
+            stats.requests += 1
+            stats.wall += wall
+            stats.db += profile.db_time
+            stats.template += profile.template_time
+            stats.queries += profile.queries
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if wall <= bound:
+                    stats.buckets[i] += 1
+            if repeated:
+                stats.n_plus_one += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {endpoint: _copy(stats) for endpoint, stats in sorted(self._endpoints.items())}
+
+    def clear(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+def _copy(stats):
+    copy = EndpointStats()
+    for name in EndpointStats.__slots__:
+        value = getattr(stats, name)
+        setattr(copy, name, list(value) if isinstance(value, list) else value)
+    return copy
+
+
+registry = ProfileRegistry()
+
+
+def _profile():
+    return g.get("_profile") if has_request_context() else None
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _profile()
+    if profile is not None:
+        profile._query_started.append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _profile()
+    if profile is None or not profile._query_started:
+        return
+    profile.db_time += time.perf_counter() - profile._query_started.pop()
+    profile.queries += 1
+    # Statements keep their bind placeholders, so a lazy load repeated for
+    # every row of a list shows up as one statement with a high count.
+    profile.statements[statement] += 1
+
+
+def _before_render(sender, template, context, **extra):
+    profile = _profile()
+    if profile is not None:
+        profile._templates.append(time.perf_counter())
+
+
+def _rendered(sender, template, context, **extra):
+    profile = _profile()
+    if profile is not None and profile._templates:
+        started = profile._templates.pop()
+        # Only the outermost template counts; includes run inside it.
+        if not profile._templates:
+            profile.template_time += time.perf_counter() - started
+
+
+def _repeated_selects(profile, threshold):
+    return [
+        (statement, count)
+        for statement, count in profile.statements.most_common()
+        if count >= threshold and statement.lstrip().upper().startswith("SELECT")
+    ]
+
+
+def init_profiling(app):
+    """Install the profiling hooks and ``/metrics`` when ``PROFILING`` is on."""
+    if not app.config.get("PROFILING"):
+        return
+
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+
+    @app.before_request
+    def start_profile():
+        g._profile = RequestProfile()
+        endpoint = app.config.get("PROFILE_ENDPOINT")
+        if endpoint and request.endpoint == endpoint and random.random() < app.config["PROFILE_SAMPLE_RATE"]:
+            g._cprofile = cProfile.Profile()
+            g._cprofile.enable()
+
+    @app.after_request
+    def finish_profile(response):
+        profile = g.pop("_profile", None)
+        if profile is None or request.endpoint == "metrics":
+            return response
+        wall = time.perf_counter() - profile.started
+        endpoint = request.endpoint or "unmatched"
+        repeated = _repeated_selects(profile, app.config["N_PLUS_ONE_THRESHOLD"])
+        for statement, count in repeated:
+            logger.warning("Possible N+1 in %s: %d x %s", endpoint, count, " ".join(statement.split())[:200])
+        registry.record(endpoint, wall, profile, repeated)
+        response.headers["Server-Timing"] = (
+            f"app;dur={wall * 1000:.1f}, db;dur={profile.db_time * 1000:.1f};desc=\"{profile.queries} queries\", "
+            f"tpl;dur={profile.template_time * 1000:.1f}"
+        )
+
+        cprofile = g.pop("_cprofile", None)
+        if cprofile is not None:
+            cprofile.disable()
+            directory = app.config["PROFILE_DIR"]
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{endpoint}-{time.time_ns()}.prof")
+            cprofile.dump_stats(path)
+            logger.info("Wrote profile of %s to %s", endpoint, path)
+        return response
+
+    app.add_url_rule("/metrics", "metrics", metrics)
+
+
+def metrics():
+    """Prometheus text exposition of request, query, pool and cache metrics."""
+    token = current_app.config.get("METRICS_TOKEN")
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        abort(401)
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics():
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{_label(val)}"' for key, val in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    endpoints = registry.snapshot()
+    metric("app_requests_total", "counter", "Requests served.",
+           [({"endpoint": e}, s.requests) for e, s in endpoints.items()])
+
+    lines.append("# HELP app_request_duration_seconds Wall time per request.")
+    lines.append("# TYPE app_request_duration_seconds histogram")
+    for endpoint, stats in endpoints.items():
+        name = _label(endpoint)
+        for bound, count in zip(DURATION_BUCKETS, stats.buckets):
+            lines.append(f'app_request_duration_seconds_bucket{{endpoint="{name}",le="{bound}"}} {count}')
+        lines.append(f'app_request_duration_seconds_bucket{{endpoint="{name}",le="+Inf"}} {stats.requests}')
+        lines.append(f'app_request_duration_seconds_sum{{endpoint="{name}"}} {stats.wall:.6f}')
+        lines.append(f'app_request_duration_seconds_count{{endpoint="{name}"}} {stats.requests}')
+
+    metric("app_db_seconds_total", "counter", "Time spent executing SQL.",
+           [({"endpoint": e}, f"{s.db:.6f}") for e, s in endpoints.items()])
+    metric("app_template_seconds_total", "counter", "Time spent rendering templates.",
+           [({"endpoint": e}, f"{s.template:.6f}") for e, s in endpoints.items()])
+    metric("app_db_queries_total", "counter", "SQL statements executed.",
+           [({"endpoint": e}, s.queries) for e, s in endpoints.items()])
+    metric("app_n_plus_one_requests_total", "counter", "Requests that repeated one SELECT past the N+1 threshold.",
+           [({"endpoint": e}, s.n_plus_one) for e, s in endpoints.items()])
+
+    pool = pool_metrics.snapshot()
+    metric("db_pool_checkouts_total", "counter", "Connections checked out of the pool.",
+           [({}, pool["checkouts"])])
+    metric("db_pool_slow_checkouts_total", "counter", "Checkouts that waited past DB_SLOW_CHECKOUT_MS.",
+           [({}, pool["slow_checkouts"])])
+    metric("db_pool_checkout_wait_max_seconds", "gauge", "Longest wait for a connection.",
+           [({}, f"{pool['checkout_wait_max_ms'] / 1000:.6f}")])
+    metric("db_pool_in_use", "gauge", "Connections in use at the last checkout.", [({}, pool["in_use"])])
+    metric("db_pool_capacity", "gauge", "pool_size plus max_overflow.", [({}, pool["capacity"])])
+
+    cache = fragment_cache.stats()
+    metric("fragment_cache_hits_total", "counter", "Fragment cache hits.",
+           [({"namespace": ns}, c["hits"]) for ns, c in cache.items()])
+    metric("fragment_cache_misses_total", "counter", "Fragment cache misses.",
+           [({"namespace": ns}, c["misses"]) for ns, c in cache.items()])
+    return "\n".join(lines) + "\n"
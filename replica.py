@@ -0,0 +1,106 @@
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+REPLICA_BIND = "replica"
+
+# GET views whose queries may be served by the replica. Views that write as
+# a side effect (badge unlocks, cached streaks) still send those writes, and
+# every read after them, to the primary.
+REPLICA_ENDPOINTS = frozenset({
+    "main.tips",
+    "main.tip_detail",
+    "main.tips_search",
+    "main.progress",
+    "main.badges",
+    "main.tracker",
+    "main.admin_dashboard",
+})
+
+# Flask session key: until when (epoch seconds) this browser reads from the primary.
+_PRIMARY_UNTIL = "_primary_until"
+
+
+def _replica_allowed():
+    if not has_request_context() or g.get("_db_wrote") or g.get("_db_primary"):
+        return False
+    if request.method not in ("GET", "HEAD") or request.endpoint not in REPLICA_ENDPOINTS:
+        return False
+    return session.get(_PRIMARY_UNTIL, 0) <= time.time()
+
+
+def mark_write():
+    """Send the rest of this request, and this browser for a while, to the primary.
+
+    Called for every write. Later requests read from the primary for
+    ``REPLICA_STICKY_SECONDS``, longer than the replica is expected to lag,
+    so users always see their own writes.
+    """
+    if not has_request_context() or REPLICA_BIND not in current_app.extensions["sqlalchemy"].engines:
+        # Without a replica there is nothing to stick to, and no reason to
+        # send every client a fresh session cookie.
+        return
+    g._db_wrote = True
+    session[_PRIMARY_UNTIL] = int(time.time()) + current_app.config["REPLICA_STICKY_SECONDS"]
+
+
+@contextmanager
+def use_primary():
+    """Read from the primary inside the block.
+
+    For read-then-write code reachable from replica views, such as filling a
+    cache table, which must not act on a lagging copy.
+    """
+    if not has_request_context():
+        yield
+        return
+    previous = g.get("_db_primary", False)
+    g._db_primary = True
+    try:
+        yield
+    finally:
+        g._db_primary = previous
+
+
+class RoutingSession(Session):
+    """Session that sends SELECTs of replica-safe views to the ``replica`` bind.
+
+    Everything else (writes, flushes, raw SQL, CLI commands and workers) uses
+    the primary, as does any read once the request or browser has written.
+    Without ``DATABASE_REPLICA_URL`` it behaves like the default session.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and clause is not None and getattr(clause, "is_select", False) and _replica_allowed():
+            replica = self._db.engines.get(REPLICA_BIND)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _after_flush(session_, flush_context):
+    mark_write()
+
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def _after_bulk_write(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        mark_write()
+
+
+def sync_sqlite_replica(primary_engine, replica_engine):
+    """Copy a SQLite primary onto a SQLite replica file, standing in for replication locally."""
+    if primary_engine.dialect.name != "sqlite" or replica_engine.dialect.name != "sqlite":
+        raise ValueError("Only SQLite databases can be copied; use Postgres replication otherwise.")
+    replica_engine.dispose()
+    source = primary_engine.raw_connection()
+    target = replica_engine.raw_connection()
+    try:
+        source.driver_connection.backup(target.driver_connection)
+    finally:
+        target.close()
+        source.close()
@@ -0,0 +1,196 @@
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import delete, func, insert, literal, null, select, union_all
+
+from extensions import db
+from models import DailyActivity, DailyUserActivity, Habit, HabitEntry, Mood, ToDo, User
+from stats import day_of
+
+# Days closed per transaction while backfilling, so a long backfill commits
+# as it goes and resumes where it stopped.
+ROLLUP_CHUNK_DAYS = 31
+
+METRICS = ("moods", "todos_done", "habit_entries")
+
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _midnight(day):
+    return datetime.combine(day, datetime.min.time())
+
+
+def _days(start, end):
+    return [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+
+def _activity_rows(start, end, user_id=None, signups=False):
+    """``(user_id, day, metric, count)`` rows for ``start`` to ``end`` inclusive, from one query.
+
+    Each metric is a GROUP BY over its raw table, glued together with UNION
+    ALL so a range costs one round trip. ``signups`` adds one row per day
+    with new users (``user_id`` is NULL on those).
+    """
+    since, until = _midnight(start), _midnight(end + timedelta(days=1))
+    mood_day = day_of(Mood.created_at)
+    todo_day = day_of(ToDo.created_at)
+    selects = [
+        select(Mood.user_id, mood_day, literal("moods"), func.count())
+        .where(Mood.created_at >= since, Mood.created_at < until, *_owned(Mood.user_id, user_id))
+        .group_by(Mood.user_id, mood_day),
+        select(ToDo.user_id, todo_day, literal("todos_done"), func.count())
+        .where(ToDo.done.is_(True), ToDo.created_at >= since, ToDo.created_at < until, *_owned(ToDo.user_id, user_id))
+        .group_by(ToDo.user_id, todo_day),
+        select(Habit.user_id, HabitEntry.date, literal("habit_entries"), func.count())
+        .join(Habit, Habit.id == HabitEntry.habit_id)
+        .where(HabitEntry.date >= start, HabitEntry.date <= end, *_owned(Habit.user_id, user_id))
+        .group_by(Habit.user_id, HabitEntry.date),
+    ]
+    if signups:
+        signup_day = day_of(User.created_at)
+        selects.append(
+            select(null(), signup_day, literal("signups"), func.count())
+            .where(User.created_at >= since, User.created_at < until)
+            .group_by(signup_day)
+        )
+    return db.session.execute(union_all(*selects)).all()
+
+
+def _owned(column, user_id):
+    return (column == user_id,) if user_id is not None else ()
+
+
+def user_day_counts(start, end, user_id=None):
+    """Count activity per user and day from the raw tables, ``start`` to ``end`` inclusive.
+
+    Returns ``{(user_id, day): {"moods", "todos_done", "habit_entries"}}``
+    with only the active (user, day) pairs.
+    """
+    counts = defaultdict(lambda: dict.fromkeys(METRICS, 0))
+    for row_user, day, metric, count in _activity_rows(start, end, user_id):
+        counts[(row_user, _as_date(day))][metric] = count
+    return counts
+
+
+def _site_totals(start, end):
+    """Per-user counts and site-wide rows for each day from ``start`` to ``end``, from the raw tables."""
+    totals = {day: dict(day=day, active_users=0, signups=0, **dict.fromkeys(METRICS, 0))
+              for day in _days(start, end)}
+    counts = defaultdict(lambda: dict.fromkeys(METRICS, 0))
+    for user_id, day, metric, count in _activity_rows(start, end, signups=True):
+        day = _as_date(day)
+        totals[day][metric] += count
+        if user_id is not None:
+            counts[(user_id, day)][metric] = count
+    for _user_id, day in counts:
+        totals[day]["active_users"] += 1
+    return counts, list(totals.values())
+
+
+def closed_through():
+    """The last day whose rollups are final, or None before the first backfill."""
+    return db.session.scalar(select(func.max(DailyActivity.day)))
+
+
+def _first_day():
+    firsts = [
+        db.session.scalar(select(func.min(column)))
+        for column in (User.created_at, Mood.created_at, ToDo.created_at, HabitEntry.date)
+    ]
+    firsts = [_as_date(value) for value in firsts if value is not None]
+    return min(firsts) if firsts else None
+
+
+def close_days(through=None, progress=None):
+    """Roll up every day after the last closed one, up to ``through`` (default: yesterday, UTC).
+
+    Each day is counted from the raw tables once and written in chunks of
+    ``ROLLUP_CHUNK_DAYS``, each in its own transaction. ``progress`` is
+    called with the last day of every chunk. Returns the number of days closed.
+    """
+    through = through or datetime.utcnow().date() - timedelta(days=1)
+    last = closed_through()
+    start = last + timedelta(days=1) if last else _first_day()
+    closed = 0
+    while start is not None and start <= through:
+        end = min(start + timedelta(days=ROLLUP_CHUNK_DAYS - 1), through)
+        counts, totals = _site_totals(start, end)
+        # Clear the range first so a chunk interrupted between its deletes
+        # and commit by a concurrent reopen is simply written again.
+        db.session.execute(delete(DailyUserActivity).where(DailyUserActivity.day.between(start, end)))
+        db.session.execute(delete(DailyActivity).where(DailyActivity.day.between(start, end)))
+        if counts:
+            db.session.execute(
+                insert(DailyUserActivity),
+                [dict(user_id=user_id, day=day, **values) for (user_id, day), values in counts.items()],
+            )
+        db.session.execute(insert(DailyActivity), totals)
+        db.session.commit()
+        closed += len(totals)
+        if progress:
+            progress(end)
+        start = end + timedelta(days=1)
+    return closed
+
+
+def reopen_days(since):
+    """Drop the rollups from ``since`` on, for writes that landed on closed days.
+
+    Reads count those days from the raw tables again until the next
+    :func:`close_days`. The caller commits.
+    """
+    db.session.execute(delete(DailyUserActivity).where(DailyUserActivity.day >= since))
+    db.session.execute(delete(DailyActivity).where(DailyActivity.day >= since))
+
+
+def get_user_activity(user_id, start_date):
+    """Like :func:`stats.get_daily_counts`, but reading closed days from the rollup.
+
+    Closed days are read from the user's ``daily_user_activity`` rows; the
+    days after them, normally just today, are counted from the raw tables.
+    """
+    moods, todos_done, habit_entries = {}, {}, {}
+    by_metric = dict(zip(METRICS, (moods, todos_done, habit_entries)))
+    closed = closed_through()
+    if closed is not None and closed >= start_date:
+        for row in db.session.scalars(
+            select(DailyUserActivity)
+            .where(DailyUserActivity.user_id == user_id, DailyUserActivity.day.between(start_date, closed))
+        ):
+            for name, counts in by_metric.items():
+                if getattr(row, name):
+                    counts[row.day.isoformat()] = getattr(row, name)
+
+    live_start = max(start_date, closed + timedelta(days=1)) if closed is not None else start_date
+    today = datetime.utcnow().date()
+    if live_start <= today:
+        for (_user_id, day), values in user_day_counts(live_start, today, user_id).items():
+            for name, count in values.items():
+                if count:
+                    by_metric[name][day.isoformat()] = count
+    return moods, todos_done, habit_entries
+
+
+def get_activity_trends(start_date, today):
+    """Site-wide rows (DAU, signups and activity) per day from ``start_date`` to ``today``.
+
+    Closed days come from ``daily_activity``; the open days after them,
+    normally just today, are counted from the raw tables.
+    """
+    rows = [
+        dict(day=row.day, active_users=row.active_users, signups=row.signups,
+             **{name: getattr(row, name) for name in METRICS})
+        for row in db.session.scalars(
+            select(DailyActivity).where(DailyActivity.day >= start_date).order_by(DailyActivity.day)
+        )
+    ]
+    live_start = rows[-1]["day"] + timedelta(days=1) if rows else start_date
+    if live_start <= today:
+        rows.extend(_site_totals(live_start, today)[1])
+    return rows
@@ -1,24 +1,69 @@
-from collections import OrderedDict
+import os
 from datetime import date, datetime, timedelta
 from functools import wraps
 
 from flask import (
     Blueprint,
+    Response,
     abort,
+    current_app,
     flash,
     g,
+    jsonify,
     redirect,
     render_template,
     request,
+    send_from_directory,
     session,
+    stream_with_context,
     url_for,
 )
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from werkzeug.local import LocalProxy
+from badges import BADGES, BADGES_BY_ID, award_badges, badge_counts
+from cache import fragment_cache
+from conditional import add_validators, not_modified
+from dbutil import insert_ignore, view_options
 from extensions import db
-from forms import AdminUserForm, HabitTrackerForm, LoginForm, MoodForm, SignupForm, TipForm, ToDoForm
-from models import Habit, HabitEntry, Mood, Tip, ToDo, User
+from forms import (
+    MOOD_CHOICES,
+    AdminUserForm,
+    ExportJobForm,
+    HabitTrackerForm,
+    ImportForm,
+    LoginForm,
+    MoodForm,
+    SignupForm,
+    TipForm,
+    ToDoForm,
+)
+from habits import complete_all_habits, get_habit_streaks, invalidate_streaks, toggle_habit_entry
+from identity import CurrentUser, identity_cache
+from jobs import enqueue, job_counts
+from models import Habit, HabitEntry, Job, Mood, Tip, ToDo, User, UserBadge
+from pagination import keyset_paginate, page_size
+from rollups import get_activity_trends, get_user_activity
+from search import search_tips
+from stats import (
+    adjust_user_stats,
+    get_global_stats,
+    get_tip_version,
+    get_tips_version,
+    get_user_stats,
+    get_user_version,
+)
+from sync import CursorExpired, record_changes, sync_page
 
 main = Blueprint("main", __name__)
 
+PROGRESS_WINDOWS = (7, 14, 30, 90, 365)
+PROGRESS_DEFAULT_DAYS = 14
+TREND_WINDOWS = (30, 90, 365)
+TREND_DEFAULT_DAYS = 30
+
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -46,77 +91,45 @@ def get_current_user():
     if getattr(g, "_current_user", None) is not None:
         return g._current_user
     user = None
-    if session.get("user_id"):
-        user = User.query.get(session["user_id"])
+    user_id = session.get("user_id")
+    if user_id:
+        user = identity_cache.get(user_id)
+        if user is None:
+            row = db.session.get(User, user_id)
+            if row is not None:
+                user = CurrentUser.from_user(row)
+                identity_cache.set(user)
     g._current_user = user
     return user
 
 
-def get_user_stats(user_id):
-    mood_count = Mood.query.filter_by(user_id=user_id).count()
-    todo_done_count = ToDo.query.filter_by(user_id=user_id, done=True).count()
-    habit_entries = HabitEntry.query.join(Habit).filter(Habit.user_id == user_id).count()
-    return {
-        "mood_count": mood_count,
-        "todo_done_count": todo_done_count,
-        "habit_entries": habit_entries,
-    }
-
-
-def get_badge_definitions():
-    return [
-        {
-            "id": "mood_explorer",
-            "name": "Mood Explorer",
-            "desc": "Logged moods 5+ times",
-            "emoji": "🧭",
-            "check": lambda stats: stats["mood_count"] >= 5,
-        },
-        {
-            "id": "task_slayer",
-            "name": "Task Slayer",
-            "desc": "Completed 10 tasks",
-            "emoji": "✅",
-            "check": lambda stats: stats["todo_done_count"] >= 10,
-        },
-        {
-            "id": "habit_streak",
-            "name": "Habit Streak",
-            "desc": "Marked habits 7 times",
-            "emoji": "🔥",
-            "check": lambda stats: stats["habit_entries"] >= 7,
-        },
-        {
-            "id": "consistency_pro",
-            "name": "Consistency Pro",
-            "desc": "Kept a strong routine",
-            "emoji": "🏅",
-            "check": lambda stats: stats["mood_count"] >= 20 and stats["todo_done_count"] >= 20,
-        },
-    ]
-
+def _lazy_form(name, form_class):
+    def load():
+        if name not in g:
+            setattr(g, name, form_class())
+        return getattr(g, name)
 
-def calculate_badges(user_id):
-    stats = get_user_stats(user_id)
-    badges = []
-    for badge in get_badge_definitions():
-        if badge["check"](stats):
-            badges.append({k: v for k, v in badge.items() if k != "check"})
-    return badges
+    return LocalProxy(load)
 
 
 @main.context_processor
 def inject_auth_forms():
     return dict(
-        signup_form=SignupForm(),
-        login_form=LoginForm(),
+        signup_form=_lazy_form("_signup_form", SignupForm),
+        login_form=_lazy_form("_login_form", LoginForm),
         current_user=get_current_user(),
     )
 
 
 @main.before_app_request
 def load_user():
-    get_current_user()
+    if request.endpoint != "static":
+        get_current_user()
+
+
+@main.after_app_request
+def apply_validators(response):
+    return add_validators(response)
 
 @main.route("/")
 def home():
@@ -129,8 +142,57 @@ def tips():
     user = get_current_user()
     if user and user.is_admin:
         return redirect(url_for("main.admin_dashboard"))
-    all_tips = Tip.query.order_by(Tip.created_at.desc()).all()
-    return render_template("tips.html", tips=all_tips)
+    latest, count = get_tips_version()
+    response = not_modified(latest, count, last_modified=latest, user=user)
+    if response:
+        return response
+
+    # The version is part of the key so a lagging replica, read right after an
+    # invalidation, cannot cache an old list under the current key.
+    key = "{}:{}:{}:{}:{}".format(
+        latest, count, request.args.get("before", ""), request.args.get("after", ""), page_size()
+    )
+
+    def render_list():
+        page = keyset_paginate(Tip.query.options(*view_options()), (Tip.created_at, Tip.id))
+        return render_template("components/_tip_list.html", tips=page.items, page=page)
+
+    tip_list_html = fragment_cache.get_or_render("tips:list", key, render_list)
+    return render_template("tips.html", tip_list_html=tip_list_html)
+
+
+@main.route("/tips/search")
+def tips_search():
+    user = get_current_user()
+    if user and user.is_admin:
+        return redirect(url_for("main.admin_dashboard"))
+    latest, count = get_tips_version()
+    response = not_modified(latest, count, last_modified=latest, user=user)
+    if response:
+        return response
+
+    query = request.args.get("q", "").strip()
+    category = request.args.get("category") or None
+    page = max(request.args.get("page", 1, type=int) or 1, 1)
+    limit = page_size()
+    # Keyed on the query as typed, since the fragment echoes it back in its
+    # text and links; repr() keeps free text from running into other fields.
+    key = "{}:{}:{}:{}:{!r}:{!r}".format(latest, count, page, limit, category or "", query)
+
+    def render_results():
+        results = search_tips(query, category, limit=limit, offset=(page - 1) * limit, options=view_options())
+        return render_template(
+            "components/_tip_search.html", results=results, query=query, category=category, page=page
+        )
+
+    results_html = fragment_cache.get_or_render("tips:search", key, render_results)
+    return render_template("tips.html", tip_list_html=results_html, query=query)
+
+
+def _tip_detail_key(tip_id, updated_at):
+    # The version is part of the key so a lagging replica cannot cache an
+    # old tip under the current key.
+    return f"{tip_id}:{updated_at}"
 
 
 @main.route("/tip/<int:tip_id>")
@@ -138,8 +200,18 @@ def tip_detail(tip_id):
     user = get_current_user()
     if user and user.is_admin:
         return redirect(url_for("main.admin_dashboard"))
-    tip = Tip.query.get_or_404(tip_id)
-    return render_template("tip.html", tip=tip)
+    updated_at = get_tip_version(tip_id)
+    if updated_at is not None:
+        response = not_modified(updated_at, last_modified=updated_at, user=user)
+        if response:
+            return response
+
+    def render_detail():
+        tip = Tip.query.options(*view_options()).get_or_404(tip_id)
+        return render_template("components/_tip_detail.html", tip=tip)
+
+    tip_html = fragment_cache.get_or_render("tips:detail", _tip_detail_key(tip_id, updated_at), render_detail)
+    return render_template("tip.html", tip_html=tip_html)
 
 @main.route("/tracker")
 @login_required  
@@ -147,22 +219,15 @@ def tracker():
     user = get_current_user()
     if user.is_admin:
         return redirect(url_for("main.admin_dashboard"))
-    mood_count = Mood.query.filter_by(user_id=user.id).count()
-    todo_count = ToDo.query.filter_by(user_id=user.id).count()
-    todo_done_count = ToDo.query.filter_by(user_id=user.id, done=True).count()
-    habit_count = Habit.query.filter_by(user_id=user.id).count()
-    badges = calculate_badges(user.id)
+    last_change = get_user_version(user.id)
+    response = not_modified(last_change, last_modified=last_change, user=user)
+    if response:
+        return response
+    stats = get_user_stats(user.id)
+    unlocked = award_badges(user.id, stats)
+    badges = [badge.as_dict() for badge in BADGES if badge.id in unlocked]
 
-    return render_template(
-        "tracker.html",
-        summary={
-            "moods": mood_count,
-            "todos": todo_count,
-            "todos_done": todo_done_count,
-            "habits": habit_count,
-        },
-        badges=badges,
-    )
+    return render_template("tracker.html", summary=stats, badges=badges)
 
 
 @main.route("/badges")
@@ -171,25 +236,25 @@ def badges():
     user = get_current_user()
     if user.is_admin:
         return redirect(url_for("main.admin_dashboard"))
+    last_change = get_user_version(user.id)
+    response = not_modified(last_change, last_modified=last_change, user=user)
+    if response:
+        return response
     stats = get_user_stats(user.id)
-    all_badges = []
-    for badge in get_badge_definitions():
-        unlocked = badge["check"](stats)
-        all_badges.append(
-            {
-                "id": badge["id"],
-                "name": badge["name"],
-                "desc": badge["desc"],
-                "emoji": badge["emoji"],
-                "unlocked": unlocked,
-            }
-        )
+    unlocked = award_badges(user.id, stats)
+    all_badges = [
+        dict(badge.as_dict(), unlocked=badge.id in unlocked, unlocked_at=unlocked.get(badge.id))
+        for badge in BADGES
+    ]
     return render_template("badges.html", badges=all_badges, stats=stats)
 
 @main.route("/mood", methods=["GET", "POST"])
 @login_required
 def mood():
     user = get_current_user()
+    response = not_modified(get_user_version(user.id), user=user, forms=True)
+    if response:
+        return response
     mood_form = MoodForm()
     if request.method == "POST":
         if mood_form.validate_on_submit():
@@ -205,12 +270,10 @@ def mood():
         else:
             flash("Please correct the errors in the form.", "danger")
 
-    moods = (
-        Mood.query.filter_by(user_id=user.id)
-        .order_by(Mood.created_at.desc())
-        .all()
+    page = keyset_paginate(
+        Mood.query.filter_by(user_id=user.id).options(*view_options()), (Mood.created_at, Mood.id)
     )
-    return render_template("mood.html", mood_form=mood_form, moods=moods)
+    return render_template("mood.html", mood_form=mood_form, moods=page.items, page=page)
 
 
 @main.route("/mood/edit/<int:mood_id>", methods=["GET", "POST"])
@@ -251,6 +314,11 @@ def mood_delete(mood_id):
 @login_required
 def habit():
     user = get_current_user()
+    today = date.today()
+    # Current streaks lapse with the calendar, not only when data changes.
+    response = not_modified(get_user_version(user.id), today, user=user, forms=True)
+    if response:
+        return response
     habit_form = HabitTrackerForm()
     if request.method == "POST":
         if habit_form.validate_on_submit():
@@ -266,21 +334,24 @@ def habit():
         else:
             flash("Please correct the errors in the form.", "danger")
 
-    habits = (
-        Habit.query.filter_by(user_id=user.id)
-        .order_by(Habit.created_at.desc())
-        .all()
+    page = keyset_paginate(
+        Habit.query.filter_by(user_id=user.id).options(*view_options()), (Habit.created_at, Habit.id)
     )
 
-    today = date.today()
-    entries_today = HabitEntry.query.join(Habit).filter(
-        Habit.user_id == user.id,
+    entries_today = HabitEntry.query.filter(
+        HabitEntry.habit_id.in_([h.id for h in page.items]),
         HabitEntry.date == today,
-    ).all()
+    ).all() if page.items else []
     completed_today = set(e.habit_id for e in entries_today)
+    streaks = get_habit_streaks(page.items, today, rates=True)
 
     return render_template(
-        "habit.html", habit_form=habit_form, habits=habits, completed_today=completed_today
+        "habit.html",
+        habit_form=habit_form,
+        habits=page.items,
+        page=page,
+        completed_today=completed_today,
+        streaks=streaks,
     )
 
 
@@ -288,22 +359,24 @@ def habit():
 @login_required
 def habit_complete(habit_id):
     user = get_current_user()
-    habit_obj = Habit.query.get_or_404(habit_id)
-    if habit_obj.user_id != user.id:
-        flash("You are not authorized to modify that habit.", "danger")
-        abort(403)
-
-    today = date.today()
-    existing = HabitEntry.query.filter_by(habit_id=habit_id, date=today).first()
-    if existing:
-        db.session.delete(existing)
-        db.session.commit()
-        flash("Marked as not completed for today.", "info")
-    else:
-        entry = HabitEntry(habit_id=habit_id, date=today)
-        db.session.add(entry)
-        db.session.commit()
+    completed = toggle_habit_entry(user.id, habit_id, date.today())
+    if completed is None:
+        abort(404)
+    db.session.commit()
+    if completed:
         flash("Marked completed for today.", "success")
+    else:
+        flash("Marked as not completed for today.", "info")
+    return redirect(url_for("main.habit"))
+
+
+@main.route("/habit/complete-all", methods=["POST"])
+@login_required
+def habit_complete_all():
+    user = get_current_user()
+    added = complete_all_habits(user.id, date.today())
+    db.session.commit()
+    flash(f"Marked {added} habit(s) completed for today.", "success")
     return redirect(url_for("main.habit"))
 
 
@@ -346,6 +419,9 @@ def habit_delete(habit_id):
 @login_required
 def todo():
     user = get_current_user()
+    response = not_modified(get_user_version(user.id), user=user, forms=True)
+    if response:
+        return response
     todo_form = ToDoForm()
     if request.method == "POST":
         if todo_form.validate_on_submit():
@@ -362,12 +438,10 @@ def todo():
         else:
             flash("Please correct the errors in the form.", "danger")
 
-    todos = (
-        ToDo.query.filter_by(user_id=user.id)
-        .order_by(ToDo.created_at.desc())
-        .all()
+    page = keyset_paginate(
+        ToDo.query.filter_by(user_id=user.id).options(*view_options()), (ToDo.created_at, ToDo.id)
     )
-    return render_template("todo.html", todo_form=todo_form, todos=todos)
+    return render_template("todo.html", todo_form=todo_form, todos=page.items, page=page)
 
 
 @main.route("/todo/edit/<int:todo_id>", methods=["GET", "POST"])
@@ -428,15 +502,27 @@ def signup():
     return render_template("signup.html", form=form)
 
 
+def log_in(email, password):
+    """Check credentials and start a session; return the User or ``None``."""
+    user = User.query.filter_by(email=email).first()
+    if not user or not user.check_password(password):
+        return None
+    if user.password_needs_rehash():
+        user.set_password(password)
+        db.session.commit()
+    session.clear()
+    session["user_id"] = user.id
+    identity_cache.set(CurrentUser.from_user(user))
+    return user
+
+
 @main.route("/login", methods=["GET", "POST"])
 def login():
     form = LoginForm()
     if request.method == "POST":
         if form.validate_on_submit():
-            user = User.query.filter_by(email=form.email.data).first()
-            if user and user.check_password(form.password.data):
-                session.clear()
-                session["user_id"] = user.id
+            user = log_in(form.email.data, form.password.data)
+            if user:
                 flash("Logged in successfully", "success")
                 next_page = request.args.get("next")
                 if next_page and next_page.startswith("/"):
@@ -460,84 +546,87 @@ def logout():
 @main.route("/progress")
 @login_required
 def progress():
-    DAYS = 14
+    days = request.args.get("days", PROGRESS_DEFAULT_DAYS, type=int)
+    if days not in PROGRESS_WINDOWS:
+        days = PROGRESS_DEFAULT_DAYS
     user = get_current_user()
     today = datetime.utcnow().date()
-    start_date = today - timedelta(days=DAYS - 1)
-    labels = [(start_date + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(DAYS)]
+    response = not_modified(get_user_version(user.id), today, user=user)
+    if response:
+        return response
+    start_date = today - timedelta(days=days - 1)
+    labels = [(start_date + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days)]
 
-    moods_count = OrderedDict((label, 0) for label in labels)
-    todos_done_count = OrderedDict((label, 0) for label in labels)
-    habits_done_count = OrderedDict((label, 0) for label in labels)
-
-    moods = Mood.query.filter(
-        Mood.user_id == user.id,
-        Mood.created_at >= datetime.combine(start_date, datetime.min.time()),
-    ).all()
-    for m in moods:
-        key = m.created_at.date().strftime("%Y-%m-%d")
-        if key in moods_count:
-            moods_count[key] += 1
-
-    todos = ToDo.query.filter(
-        ToDo.user_id == user.id,
-        ToDo.done.is_(True),
-        ToDo.created_at >= datetime.combine(start_date, datetime.min.time()),
-    ).all()
-    for t in todos:
-        key = t.created_at.date().strftime("%Y-%m-%d")
-        if key in todos_done_count:
-            todos_done_count[key] += 1
-
-    habit_entries = HabitEntry.query.join(Habit).filter(
-        Habit.user_id == user.id,
-        HabitEntry.date >= start_date,
-    ).all()
-    for e in habit_entries:
-        key = e.date.strftime("%Y-%m-%d")
-        if key in habits_done_count:
-            habits_done_count[key] += 1
+    moods_count, todos_done_count, habits_done_count = get_user_activity(user.id, start_date)
 
     return render_template(
         "progress.html",
         labels=labels,
-        moods_data=list(moods_count.values()),
-        todos_data=list(todos_done_count.values()),
-        habits_data=list(habits_done_count.values()),
-        days=DAYS,
+        moods_data=[moods_count.get(label, 0) for label in labels],
+        todos_data=[todos_done_count.get(label, 0) for label in labels],
+        habits_data=[habits_done_count.get(label, 0) for label in labels],
+        days=days,
+        windows=PROGRESS_WINDOWS,
     )
 
 
+def _export_response(resource, user_id=None):
+    from export import EXPORTS, FORMATS, stream_export
+
+    if resource not in EXPORTS:
+        abort(404)
+    fmt = request.args.get("format", "csv")
+    if fmt not in FORMATS:
+        abort(400)
+    compress = request.args.get("gzip") in ("1", "true")
+    filename = f"{resource}.{fmt}" + (".gz" if compress else "")
+    response = Response(
+        stream_with_context(stream_export(resource, fmt, user_id, compress)),
+        mimetype="application/gzip" if compress else FORMATS[fmt],
+    )
+    response.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+@main.route("/export/<resource>")
+@login_required
+def export(resource):
+    """Download the current user's rows as CSV or NDJSON (``?format=``, ``?gzip=1``)."""
+    return _export_response(resource, get_current_user().id)
+
+
 @main.route("/admin")
 @admin_required
 def admin_dashboard():
-    total_users = User.query.count()
-    total_moods = Mood.query.count()
-    total_tasks = ToDo.query.count()
-    total_habits = Habit.query.count()
-    total_tips = Tip.query.count()
-    recent_users = User.query.order_by(User.created_at.desc()).limit(5).all()
-    recent_tips = Tip.query.order_by(Tip.updated_at.desc()).limit(5).all()
+    days = request.args.get("days", TREND_DEFAULT_DAYS, type=int)
+    if days not in TREND_WINDOWS:
+        days = TREND_DEFAULT_DAYS
+    today = datetime.utcnow().date()
+    trends = get_activity_trends(today - timedelta(days=days - 1), today)
+    recent_users = User.query.options(*view_options()).order_by(User.created_at.desc()).limit(5).all()
+    recent_tips = (
+        Tip.query.options(*view_options(joinedload(Tip.author)))
+        .order_by(Tip.updated_at.desc())
+        .limit(5)
+        .all()
+    )
 
     return render_template(
         "admin/dashboard.html",
-        stats={
-            "users": total_users,
-            "moods": total_moods,
-            "tasks": total_tasks,
-            "habits": total_habits,
-            "tips": total_tips,
-        },
+        stats=get_global_stats(),
         recent_users=recent_users,
         recent_tips=recent_tips,
+        trends=[dict(row, day=row["day"].isoformat()) for row in trends],
+        days=days,
+        windows=TREND_WINDOWS,
     )
 
 
 @main.route("/admin/tips")
 @admin_required
 def admin_tips():
-    tips = Tip.query.order_by(Tip.created_at.desc()).all()
-    return render_template("admin/tips.html", tips=tips)
+    page = keyset_paginate(Tip.query.options(*view_options(joinedload(Tip.author))), (Tip.created_at, Tip.id))
+    return render_template("admin/tips.html", tips=page.items, page=page)
 
 
 @main.route("/admin/tips/new", methods=["GET", "POST"])
@@ -549,10 +638,12 @@ def admin_tip_create():
             title=form.title.data,
             body=form.body.data,
             category=form.category.data or None,
-            author=get_current_user(),
+            author_id=get_current_user().id,
         )
         db.session.add(tip)
         db.session.commit()
+        fragment_cache.invalidate("tips:list")
+        fragment_cache.invalidate("tips:search")
         flash("Tip created", "success")
         return redirect(url_for("main.admin_tips"))
     return render_template("admin/tip_form.html", form=form, title="Add tip")
@@ -564,10 +655,14 @@ def admin_tip_edit(tip_id):
     tip = Tip.query.get_or_404(tip_id)
     form = TipForm(obj=tip)
     if request.method == "POST" and form.validate_on_submit():
+        detail_key = _tip_detail_key(tip_id, tip.updated_at)
         tip.title = form.title.data
         tip.body = form.body.data
         tip.category = form.category.data or None
         db.session.commit()
+        fragment_cache.invalidate("tips:list")
+        fragment_cache.invalidate("tips:search")
+        fragment_cache.invalidate("tips:detail", detail_key)
         flash("Tip updated", "success")
         return redirect(url_for("main.admin_tips"))
     return render_template("admin/tip_form.html", form=form, title="Edit tip")
@@ -577,8 +672,12 @@ def admin_tip_edit(tip_id):
 @admin_required
 def admin_tip_delete(tip_id):
     tip = Tip.query.get_or_404(tip_id)
+    detail_key = _tip_detail_key(tip_id, tip.updated_at)
     db.session.delete(tip)
     db.session.commit()
+    fragment_cache.invalidate("tips:list")
+    fragment_cache.invalidate("tips:search")
+    fragment_cache.invalidate("tips:detail", detail_key)
     flash("Tip deleted", "info")
     return redirect(url_for("main.admin_tips"))
 
@@ -586,9 +685,107 @@ def admin_tip_delete(tip_id):
 @main.route("/admin/users")
 @admin_required
 def admin_users():
-    users = User.query.order_by(User.created_at.desc()).all()
-    forms = {user.id: AdminUserForm(obj=user) for user in users}
-    return render_template("admin/users.html", users=users, forms=forms)
+    # users.created_at was added after the first accounts and only backfilled
+    # by migration 5, so the id alone is the stable key here.
+    page = keyset_paginate(User.query.options(*view_options()), (User.id,))
+    forms = {user.id: AdminUserForm(obj=user) for user in page.items}
+    return render_template("admin/users.html", users=page.items, page=page, forms=forms)
+
+
+@main.route("/admin/badges")
+@admin_required
+def admin_badges():
+    query = (
+        db.session.query(UserBadge.user_id, UserBadge.badge_id, UserBadge.unlocked_at, User.username)
+        .join(User, User.id == UserBadge.user_id)
+    )
+    page = keyset_paginate(query, (UserBadge.unlocked_at, UserBadge.user_id, UserBadge.badge_id))
+    return render_template(
+        "admin/badges.html",
+        badges=BADGES,
+        badges_by_id=BADGES_BY_ID,
+        counts=badge_counts(),
+        unlocks=page.items,
+        page=page,
+    )
+
+
+@main.route("/admin/badges/evaluate", methods=["POST"])
+@admin_required
+def admin_badges_evaluate():
+    enqueue("sync_badges", dedupe=True)
+    db.session.commit()
+    flash("Badge evaluation queued; new unlocks appear once a worker has run it.", "success")
+    return redirect(url_for("main.admin_badges"))
+
+
+@main.route("/admin/export/<resource>")
+@admin_required
+def admin_export(resource):
+    """Download every user's rows as CSV or NDJSON."""
+    return _export_response(resource)
+
+
+@main.route("/admin/import", methods=["GET", "POST"])
+@admin_required
+def admin_import():
+    from importer import ImportFileError, detect_format, file_checksum, read_rows, run_import
+
+    form = ImportForm()
+    result = None
+    if request.method == "POST" and form.validate_on_submit():
+        upload = form.file.data
+        filename = upload.filename or ""
+        try:
+            result = run_import(
+                form.resource.data,
+                read_rows(upload.stream, detect_format(filename), compressed=filename.lower().endswith(".gz")),
+                file_checksum(upload.stream),
+                source=filename,
+                user_id=form.user_id.data,
+            )
+        except ImportFileError as error:
+            form.file.errors.append(str(error))
+            flash(f"Could not read {filename or 'the file'}.", "danger")
+        else:
+            flash(f"Imported {form.resource.data}: {result.summary()}", "success")
+    return render_template("admin/import.html", form=form, result=result)
+
+
+@main.route("/admin/jobs", methods=["GET", "POST"])
+@admin_required
+def admin_jobs():
+    form = ExportJobForm()
+    if request.method == "POST" and form.validate_on_submit():
+        enqueue("export", {"resource": form.resource.data, "fmt": form.format.data}, dedupe=True)
+        db.session.commit()
+        flash(f"Export of {form.resource.data} queued.", "success")
+        return redirect(url_for("main.admin_jobs"))
+    page = keyset_paginate(Job.query.options(*view_options()), (Job.created_at, Job.id))
+    return render_template("admin/jobs.html", form=form, jobs=page.items, page=page, counts=job_counts())
+
+
+@main.route("/admin/jobs/<int:job_id>/retry", methods=["POST"])
+@admin_required
+def admin_job_retry(job_id):
+    job = Job.query.get_or_404(job_id)
+    if job.status == "failed":
+        job.status = "queued"
+        job.attempts = 0
+        job.run_at = datetime.utcnow()
+        job.finished_at = None
+        db.session.commit()
+        flash(f"Job {job_id} queued again.", "success")
+    return redirect(url_for("main.admin_jobs"))
+
+
+@main.route("/admin/jobs/<int:job_id>/download")
+@admin_required
+def admin_job_download(job_id):
+    job = Job.query.get_or_404(job_id)
+    if job.kind != "export" or job.status != "done" or not job.result:
+        abort(404)
+    return send_from_directory(current_app.config["EXPORT_DIR"], os.path.basename(job.result), as_attachment=True)
 
 
 @main.route("/admin/users/<int:user_id>/role", methods=["POST"])
@@ -599,7 +796,344 @@ def admin_user_role(user_id):
     if form.validate_on_submit():
         user.is_admin = form.is_admin.data
         db.session.commit()
+        identity_cache.invalidate(user.id)
         flash(f"Updated role for {user.username}", "success")
     else:
         flash("Unable to update role", "danger")
-    return redirect(url_for("main.admin_users"))
\ No newline at end of file
+    return redirect(url_for("main.admin_users"))
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+API_MAX_ITEMS = 500
+API_SYNC_LIMIT = 500
+MOOD_VALUES = {value for value, _ in MOOD_CHOICES}
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400, index=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.index = index
+
+
+@api.errorhandler(ApiError)
+def handle_api_error(error):
+    body = {"error": error.message}
+    if error.index is not None:
+        body["index"] = error.index
+    return jsonify(body), error.status
+
+
+def api_login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not get_current_user():
+            return jsonify(error="Authentication required"), 401
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
+def _text(max_length=None, required=False):
+    def check(value):
+        if value is None and not required:
+            return None
+        if not isinstance(value, str) or (required and not value.strip()):
+            raise ValueError("must be a non-empty string" if required else "must be a string")
+        if max_length and len(value) > max_length:
+            raise ValueError(f"must be at most {max_length} characters")
+        return value
+
+    return check
+
+
+def _choice(values):
+    def check(value):
+        if value not in values:
+            raise ValueError("must be one of " + ", ".join(sorted(values)))
+        return value
+
+    return check
+
+
+def _boolean(value):
+    if not isinstance(value, bool):
+        raise ValueError("must be true or false")
+    return value
+
+
+def _integer(value):
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError("must be an integer")
+    return value
+
+
+def _datetime(value):
+    if not isinstance(value, str):
+        raise ValueError("must be an ISO 8601 datetime")
+    return datetime.fromisoformat(value)
+
+
+def _date(value):
+    if not isinstance(value, str):
+        raise ValueError("must be an ISO 8601 date")
+    return date.fromisoformat(value)
+
+
+# Per resource: model, writable fields, fields required on create, counter name.
+API_RESOURCES = {
+    "moods": {
+        "model": Mood,
+        "fields": {"mood": _choice(MOOD_VALUES), "notes": _text(), "created_at": _datetime},
+        "required": ("mood",),
+        "counter": "moods",
+    },
+    "todos": {
+        "model": ToDo,
+        "fields": {
+            "task": _text(255, required=True),
+            "detail": _text(),
+            "done": _boolean,
+            "created_at": _datetime,
+        },
+        "required": ("task",),
+        "counter": "todos",
+    },
+    "habit-entries": {
+        "model": HabitEntry,
+        "fields": {"habit_id": _integer, "date": _date},
+        "required": ("habit_id",),
+        "counter": "habit_entries",
+    },
+}
+SYNC_KIND_BY_RESOURCE = {"moods": "moods", "todos": "todos", "habit-entries": "habit_entries"}
+
+
+def _resource(name):
+    spec = API_RESOURCES.get(name)
+    if spec is None:
+        abort(404)
+    return spec
+
+
+def _json_list(key):
+    if not request.is_json:
+        raise ApiError("Expected an application/json body", 415)
+    payload = request.get_json(silent=True)
+    items = payload.get(key) if isinstance(payload, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ApiError(f'"{key}" must be a non-empty list')
+    if len(items) > API_MAX_ITEMS:
+        raise ApiError(f"At most {API_MAX_ITEMS} items per request", 413)
+    return items
+
+
+def _clean(item, index, fields, required=(), with_id=False):
+    if not isinstance(item, dict):
+        raise ApiError("Each item must be an object", index=index)
+    unknown = set(item) - set(fields) - ({"id"} if with_id else set())
+    if unknown:
+        raise ApiError("Unknown field(s): " + ", ".join(sorted(unknown)), index=index)
+    for name in required:
+        if item.get(name) is None:
+            raise ApiError(f'"{name}" is required', index=index)
+    row = {}
+    if with_id:
+        try:
+            row["id"] = _integer(item.get("id"))
+        except ValueError:
+            raise ApiError('"id" must be an integer', index=index)
+    for name, check in fields.items():
+        if name in item:
+            try:
+                row[name] = check(item[name])
+            except ValueError as exc:
+                raise ApiError(f'"{name}" {exc}', index=index)
+    return row
+
+
+def _owned_by(model, user_id):
+    if model is HabitEntry:
+        return HabitEntry.habit_id.in_(select(Habit.id).where(Habit.user_id == user_id))
+    return model.user_id == user_id
+
+
+def _api_json(obj):
+    if isinstance(obj, Mood):
+        return {"id": obj.id, "mood": obj.mood, "notes": obj.notes, "created_at": obj.created_at.isoformat()}
+    if isinstance(obj, ToDo):
+        return {
+            "id": obj.id,
+            "task": obj.task,
+            "detail": obj.detail,
+            "done": bool(obj.done),
+            "created_at": obj.created_at.isoformat(),
+        }
+    if isinstance(obj, Habit):
+        return {
+            "id": obj.id,
+            "habit": obj.habit,
+            "frequency": obj.frequency,
+            "created_at": obj.created_at.isoformat(),
+        }
+    return {"id": obj.id, "habit_id": obj.habit_id, "date": obj.date.isoformat()}
+
+
+def _commit_or_conflict():
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        raise ApiError("Conflicts with an existing row", 409)
+
+
+@api.route("/login", methods=["POST"])
+def api_login():
+    payload = request.get_json(silent=True) or {}
+    user = log_in(payload.get("email"), payload.get("password"))
+    if not user:
+        return jsonify(error="Invalid email or password"), 401
+    return jsonify(id=user.id, username=user.username, is_admin=bool(user.is_admin))
+
+
+@api.route("/<resource>", methods=["POST"])
+@api_login_required
+def api_create(resource):
+    """Insert many rows in one statement and one transaction."""
+    spec = _resource(resource)
+    model = spec["model"]
+    user = get_current_user()
+    rows = [_clean(item, i, spec["fields"], spec["required"]) for i, item in enumerate(_json_list("items"))]
+
+    if model is HabitEntry:
+        habit_ids = {row["habit_id"] for row in rows}
+        owned = set(db.session.scalars(select(Habit.id).where(Habit.user_id == user.id, Habit.id.in_(habit_ids))))
+        for i, row in enumerate(rows):
+            if row["habit_id"] not in owned:
+                raise ApiError("Unknown habit", 404, index=i)
+            row.setdefault("date", date.today())
+        # Entries that already exist for (habit_id, date) are skipped, not errors.
+        stmt = insert_ignore(HabitEntry, ["habit_id", "date"])
+        invalidate_streaks(owned)
+        enqueue("refresh_streaks", {"user_id": user.id}, dedupe=True)
+    else:
+        for row in rows:
+            row["user_id"] = user.id
+        stmt = insert(model)
+
+    ids = db.session.scalars(stmt.returning(model.id), rows).all()
+    deltas = {spec["counter"]: len(ids)}
+    if model is ToDo:
+        deltas["todos_done"] = sum(1 for row in rows if row.get("done"))
+    connection = db.session.connection()
+    adjust_user_stats(connection, user.id, **deltas)
+    record_changes(connection, user.id, SYNC_KIND_BY_RESOURCE[resource], ids, "upsert")
+    _commit_or_conflict()
+
+    created = model.query.filter(model.id.in_(ids)).all() if ids else []
+    return jsonify(items=[_api_json(obj) for obj in created], skipped=len(rows) - len(ids)), 201
+
+
+@api.route("/<resource>", methods=["PATCH"])
+@api_login_required
+def api_update(resource):
+    """Update many rows by id; every id must belong to the current user."""
+    spec = _resource(resource)
+    model = spec["model"]
+    user = get_current_user()
+    fields = {name: check for name, check in spec["fields"].items() if name != "habit_id"}
+    rows = [_clean(item, i, fields, with_id=True) for i, item in enumerate(_json_list("items"))]
+    for i, row in enumerate(rows):
+        if len(row) == 1:
+            raise ApiError("Nothing to update", index=i)
+
+    ids = [row["id"] for row in rows]
+    if model is ToDo:
+        current = dict(db.session.execute(
+            select(ToDo.id, ToDo.done).where(_owned_by(ToDo, user.id), ToDo.id.in_(ids))
+        ).all())
+    else:
+        current = dict.fromkeys(db.session.scalars(select(model.id).where(_owned_by(model, user.id), model.id.in_(ids))))
+    for i, row in enumerate(rows):
+        if row["id"] not in current:
+            raise ApiError("Not found", 404, index=i)
+
+    if model is HabitEntry:
+        invalidate_streaks(select(HabitEntry.habit_id).where(HabitEntry.id.in_(ids)))
+        enqueue("refresh_streaks", {"user_id": user.id}, dedupe=True)
+    try:
+        db.session.execute(update(model), rows)
+    except IntegrityError:
+        db.session.rollback()
+        raise ApiError("Conflicts with an existing row", 409)
+    todos_done = 0
+    if model is ToDo:
+        for row in rows:
+            if "done" in row and row["done"] != bool(current[row["id"]]):
+                todos_done += 1 if row["done"] else -1
+                current[row["id"]] = row["done"]
+    connection = db.session.connection()
+    adjust_user_stats(connection, user.id, todos_done=todos_done)
+    record_changes(connection, user.id, SYNC_KIND_BY_RESOURCE[resource], ids, "upsert")
+    _commit_or_conflict()
+
+    updated = model.query.filter(model.id.in_(ids)).all()
+    return jsonify(items=[_api_json(obj) for obj in updated])
+
+
+@api.route("/<resource>", methods=["DELETE"])
+@api_login_required
+def api_delete(resource):
+    """Delete many rows by id; ids the user does not own are ignored."""
+    spec = _resource(resource)
+    model = spec["model"]
+    user = get_current_user()
+    ids = _json_list("ids")
+    if not all(isinstance(row_id, int) and not isinstance(row_id, bool) for row_id in ids):
+        raise ApiError('"ids" must be integers')
+
+    columns = (model.id, ToDo.done) if model is ToDo else (model.id,)
+    if model is HabitEntry:
+        invalidate_streaks(select(HabitEntry.habit_id).where(_owned_by(HabitEntry, user.id), HabitEntry.id.in_(ids)))
+        enqueue("refresh_streaks", {"user_id": user.id}, dedupe=True)
+    deleted = db.session.execute(
+        delete(model)
+        .where(_owned_by(model, user.id), model.id.in_(ids))
+        .returning(*columns)
+        .execution_options(synchronize_session=False)
+    ).all()
+    deltas = {spec["counter"]: -len(deleted)}
+    if model is ToDo:
+        deltas["todos_done"] = -sum(1 for row in deleted if row.done)
+    deleted_ids = [row.id for row in deleted]
+    connection = db.session.connection()
+    adjust_user_stats(connection, user.id, **deltas)
+    record_changes(connection, user.id, SYNC_KIND_BY_RESOURCE[resource], deleted_ids, "delete")
+    db.session.commit()
+    return jsonify(deleted=deleted_ids)
+
+
+@api.route("/sync")
+@api_login_required
+def api_sync():
+    """Return rows changed since ``cursor``; 0 (or a cursor from a full sync) pages through every row."""
+    user = get_current_user()
+    limit = max(1, min(request.args.get("limit", API_SYNC_LIMIT, type=int), API_SYNC_LIMIT))
+    try:
+        changes, next_cursor, has_more = sync_page(user.id, request.args.get("cursor", "0"), limit)
+    except CursorExpired:
+        return jsonify(error="Cursor expired; start a full sync with cursor=0", resync=True), 410
+    except ValueError:
+        abort(400)
+    return jsonify(
+        cursor=next_cursor,
+        has_more=has_more,
+        changes={
+            kind: {
+                "upserts": [_api_json(obj) for obj in change["upserts"]],
+                "deletes": change["deletes"],
+            }
+            for kind, change in changes.items()
+        },
+    )
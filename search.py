@@ -0,0 +1,160 @@
+import logging
+import re
+
+from sqlalchemy import column, func, literal_column, or_, select, table, text
+from sqlalchemy.exc import OperationalError
+
+from dbutil import create_index_online, dialect_name
+from extensions import db
+from models import Tip
+
+logger = logging.getLogger(__name__)
+
+# Search terms beyond this many are ignored.
+MAX_TERMS = 16
+
+# Postgres: the weighted document of a tip. The GIN index is built on this
+# exact expression, so queries must use it verbatim for the planner to pick
+# the index. The title weighs more than the body.
+TIP_DOCUMENT = (
+    "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(body, '')), 'B')"
+)
+
+# SQLite: an external-content FTS5 table over tips, kept in step by triggers
+# so every write path (admin views, seeding, raw SQL) updates the index in
+# the same transaction as the row.
+_SQLITE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS tips_fts USING fts5("
+    "title, body, content='tips', content_rowid='id', tokenize='porter unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS tips_fts_insert AFTER INSERT ON tips BEGIN "
+    "INSERT INTO tips_fts(rowid, title, body) VALUES (new.id, new.title, new.body); END",
+    "CREATE TRIGGER IF NOT EXISTS tips_fts_delete AFTER DELETE ON tips BEGIN "
+    "INSERT INTO tips_fts(tips_fts, rowid, title, body) VALUES ('delete', old.id, old.title, old.body); END",
+    "CREATE TRIGGER IF NOT EXISTS tips_fts_update AFTER UPDATE OF title, body ON tips BEGIN "
+    "INSERT INTO tips_fts(tips_fts, rowid, title, body) VALUES ('delete', old.id, old.title, old.body); "
+    "INSERT INTO tips_fts(rowid, title, body) VALUES (new.id, new.title, new.body); END",
+)
+
+# bm25() column weights for (title, body), matching the Postgres A/B weights.
+_BM25_WEIGHTS = (10.0, 1.0)
+
+tips_fts = table("tips_fts", column("rowid"), column("tips_fts"))
+
+# Engine URL -> whether tips_fts exists, looked up once per process.
+_fts5_tables = {}
+
+
+def ensure_search_index():
+    """Create the full-text index over tips and fill it from existing rows.
+
+    Returns False when this SQLite build has no FTS5; search then falls back
+    to ``LIKE`` scans.
+    """
+    if dialect_name() == "postgresql":
+        create_index_online(
+            "ix_tips_search", f"CREATE INDEX IF NOT EXISTS ix_tips_search ON tips USING GIN (({TIP_DOCUMENT}))"
+        )
+        return True
+
+    try:
+        existed = db.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tips_fts'")
+        ).first()
+        for statement in _SQLITE_DDL:
+            db.session.execute(text(statement))
+        if not existed:
+            db.session.execute(text("INSERT INTO tips_fts(tips_fts) VALUES ('rebuild')"))
+        db.session.commit()
+        _fts5_tables.pop(str(db.engine.url), None)
+    except OperationalError as error:
+        db.session.rollback()
+        logger.warning("Full-text search unavailable, falling back to LIKE: %s", error.orig)
+        return False
+    return True
+
+
+def rebuild_search_index():
+    """Re-index every tip, for an index that has drifted or was restored."""
+    if dialect_name() == "postgresql":
+        db.session.execute(text("REINDEX INDEX ix_tips_search"))
+    else:
+        db.session.execute(text("INSERT INTO tips_fts(tips_fts) VALUES ('rebuild')"))
+    db.session.commit()
+
+
+def search_terms(query):
+    return re.findall(r"\w+", (query or "").lower())[:MAX_TERMS]
+
+
+def _has_fts5():
+    url = str(db.engine.url)
+    if url not in _fts5_tables:
+        _fts5_tables[url] = db.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tips_fts'")
+        ).first() is not None
+    return _fts5_tables[url]
+
+
+def _match(terms):
+    """Return ``(select of Tip, rank column)`` restricted to tips matching every term."""
+    if dialect_name() == "postgresql":
+        document = literal_column(f"({TIP_DOCUMENT})")
+        # Each term is matched as a prefix so results show up while typing.
+        tsquery = func.to_tsquery(literal_column("'english'"), " & ".join(f"{term}:*" for term in terms))
+        rank = func.ts_rank(document, tsquery)
+        return select(Tip).where(document.op("@@")(tsquery)), rank.desc()
+
+    if _has_fts5():
+        expression = " ".join(f'"{term}"*' for term in terms)
+        rank = func.bm25(literal_column("tips_fts"), *_BM25_WEIGHTS)
+        stmt = (
+            select(Tip)
+            .join(tips_fts, tips_fts.c.rowid == Tip.id)
+            .where(tips_fts.c.tips_fts.op("MATCH")(expression))
+        )
+        return stmt, rank.asc()
+
+    stmt = select(Tip)
+    for term in terms:
+        stmt = stmt.where(or_(Tip.title.ilike(f"%{term}%"), Tip.body.ilike(f"%{term}%")))
+    return stmt, Tip.created_at.desc()
+
+
+class SearchResults:
+    """One page of ranked tips plus the category facets of all matches."""
+
+    __slots__ = ("items", "facets", "total", "has_more")
+
+    def __init__(self, items, facets, has_more):
+        self.items = items
+        self.facets = facets
+        self.total = sum(count for _category, count in facets)
+        self.has_more = has_more
+
+
+def search_tips(query, category=None, limit=20, offset=0, options=()):
+    """Search tip titles and bodies, best match first.
+
+    Without search terms every tip matches, newest first. ``facets`` lists
+    ``(category, count)`` over all matches, ignoring ``category``, so the
+    other categories can still be offered as filters; it is computed with a
+    single GROUP BY over the same match.
+    """
+    terms = search_terms(query)
+    if terms:
+        stmt, order = _match(terms)
+    else:
+        stmt, order = select(Tip), Tip.created_at.desc()
+
+    count = func.count().label("count")
+    facets = db.session.execute(
+        stmt.with_only_columns(Tip.category, count).group_by(Tip.category).order_by(count.desc(), Tip.category)
+    ).all()
+
+    if category:
+        stmt = stmt.where(Tip.category == category)
+    rows = db.session.scalars(
+        stmt.options(*options).order_by(order, Tip.id.desc()).limit(limit + 1).offset(offset)
+    ).all()
+    return SearchResults(rows[:limit], [tuple(facet) for facet in facets], len(rows) > limit)
@@ -0,0 +1,251 @@
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import Date, cast, event, func, inspect, insert, select, update
+
+from dbutil import insert_ignore
+from extensions import db
+from models import Habit, HabitEntry, Mood, Tip, ToDo, User, UserStats
+from replica import use_primary
+
+
+def _count(model, *criteria):
+    return select(func.count()).select_from(model).where(*criteria).scalar_subquery()
+
+
+def count_user_stats(user_id, connection=None):
+    """Count every per-user counter from the raw tables in a single round trip."""
+    habit_entries = (
+        select(func.count())
+        .select_from(HabitEntry)
+        .join(Habit, Habit.id == HabitEntry.habit_id)
+        .where(Habit.user_id == user_id)
+        .scalar_subquery()
+    )
+    stmt = select(
+        _count(Mood, Mood.user_id == user_id).label("moods"),
+        _count(ToDo, ToDo.user_id == user_id).label("todos"),
+        _count(ToDo, ToDo.user_id == user_id, ToDo.done.is_(True)).label("todos_done"),
+        _count(Habit, Habit.user_id == user_id).label("habits"),
+        habit_entries.label("habit_entries"),
+    )
+    row = (connection or db.session).execute(stmt).one()
+    return dict(row._mapping)
+
+
+def get_user_stats(user_id):
+    """Return the user's counters from the user_stats row, building it on first use."""
+    row = db.session.get(UserStats, user_id)
+    if row is None:
+        # The replica may lag behind; only the primary can say the row is missing.
+        with use_primary():
+            row = db.session.get(UserStats, user_id)
+            if row is None:
+                counters = count_user_stats(user_id)
+                created = db.session.execute(
+                    insert_ignore(UserStats, ["user_id"]).values(user_id=user_id, **counters)
+                ).rowcount
+                db.session.commit()
+                if created:
+                    return counters
+                # A concurrent request created the row first.
+                row = db.session.get(UserStats, user_id)
+    return row.as_dict()
+
+
+def get_user_version(user_id):
+    """Return when the user's moods, todos or habits last changed, or ``None``."""
+    row = db.session.get(UserStats, user_id)
+    return row.updated_at if row is not None else None
+
+
+def get_tips_version():
+    """Return ``(latest updated_at, row count)`` for the tips table."""
+    return tuple(db.session.execute(select(func.max(Tip.updated_at), func.count(Tip.id))).one())
+
+
+def get_tip_version(tip_id):
+    return db.session.scalar(select(Tip.updated_at).where(Tip.id == tip_id))
+
+
+def adjust_user_stats(connection, user_id, **deltas):
+    """Apply counter deltas to a user_stats row inside the caller's transaction.
+
+    Always bumps ``updated_at``, which doubles as the "latest change" version
+    of the user's data. Writes that bypass the ORM unit of work (bulk inserts,
+    upserts) call this directly; ORM flushes go through the session hooks below.
+    """
+    values = {name: getattr(UserStats, name) + delta for name, delta in deltas.items() if delta}
+    values["updated_at"] = datetime.utcnow()
+    result = connection.execute(
+        update(UserStats).where(UserStats.user_id == user_id).values(**values)
+    )
+    if result.rowcount == 0 and connection.execute(select(User.id).where(User.id == user_id)).first():
+        # No row yet: count from scratch, which already includes this write.
+        created = connection.execute(
+            insert_ignore(UserStats, ["user_id"]).values(user_id=user_id, **count_user_stats(user_id, connection))
+        ).rowcount
+        if not created:
+            # A concurrent transaction created the row first, without this
+            # write in its counts: apply the deltas to its row instead.
+            connection.execute(update(UserStats).where(UserStats.user_id == user_id).values(**values))
+
+
+def _committed_value(obj, key):
+    history = inspect(obj).attrs[key].history
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return getattr(obj, key)
+
+
+def habit_owner(session, entry):
+    if entry.habit is not None:
+        return entry.habit.user_id
+    return session.execute(select(Habit.user_id).where(Habit.id == entry.habit_id)).scalar()
+
+
+@event.listens_for(db.session, "before_flush")
+def _collect_stat_deltas(session, flush_context, instances):
+    deltas = session.info["user_stats_deltas"] = defaultdict(lambda: defaultdict(int))
+    with session.no_autoflush:
+        for sign, objects in ((1, session.new), (-1, session.deleted)):
+            for obj in objects:
+                if isinstance(obj, Mood):
+                    deltas[obj.user_id]["moods"] += sign
+                elif isinstance(obj, ToDo):
+                    deltas[obj.user_id]["todos"] += sign
+                    done = obj.done if sign > 0 else _committed_value(obj, "done")
+                    if done:
+                        deltas[obj.user_id]["todos_done"] += sign
+                elif isinstance(obj, Habit):
+                    deltas[obj.user_id]["habits"] += sign
+                elif isinstance(obj, HabitEntry):
+                    deltas[habit_owner(session, obj)]["habit_entries"] += sign
+
+        for obj in session.dirty:
+            if isinstance(obj, (Mood, ToDo, Habit)) and session.is_modified(obj):
+                # Content edits leave the counters alone but still bump updated_at.
+                deltas.setdefault(obj.user_id, defaultdict(int))
+            if isinstance(obj, ToDo) and inspect(obj).attrs.done.history.has_changes():
+                was_done = bool(_committed_value(obj, "done"))
+                if bool(obj.done) != was_done:
+                    deltas[obj.user_id]["todos_done"] += 1 if obj.done else -1
+
+        for obj in session.deleted:
+            if isinstance(obj, User):
+                deltas.pop(obj.id, None)
+
+
+@event.listens_for(db.session, "after_flush")
+def _apply_stat_deltas(session, flush_context):
+    deltas = session.info.pop("user_stats_deltas", None)
+    if not deltas:
+        return
+    connection = session.connection()
+    for user_id, counters in deltas.items():
+        if user_id is not None:
+            adjust_user_stats(connection, user_id, **counters)
+
+
+def rebuild_user_stats(fix=True):
+    """Recount every user's counters in bulk and report rows that drifted.
+
+    Returns a list of ``(user_id, stored, actual)`` tuples; ``stored`` is
+    ``None`` when the user had no row. With ``fix`` the rows are rewritten.
+    """
+    actual = {user_id: dict.fromkeys(UserStats.COUNTERS, 0) for user_id in db.session.scalars(select(User.id))}
+    grouped = {
+        "moods": select(Mood.user_id, func.count()).group_by(Mood.user_id),
+        "todos": select(ToDo.user_id, func.count()).group_by(ToDo.user_id),
+        "todos_done": select(ToDo.user_id, func.count()).where(ToDo.done.is_(True)).group_by(ToDo.user_id),
+        "habits": select(Habit.user_id, func.count()).group_by(Habit.user_id),
+        "habit_entries": select(Habit.user_id, func.count())
+        .join(HabitEntry, HabitEntry.habit_id == Habit.id)
+        .group_by(Habit.user_id),
+    }
+    for name, stmt in grouped.items():
+        for user_id, count in db.session.execute(stmt):
+            if user_id in actual:
+                actual[user_id][name] = count
+
+    stored = {row.user_id: row.as_dict() for row in db.session.scalars(select(UserStats))}
+    drift = [
+        (user_id, stored.get(user_id), counters)
+        for user_id, counters in sorted(actual.items())
+        if stored.get(user_id) != counters
+    ]
+
+    if fix and drift:
+        missing = [dict(user_id=user_id, **counters) for user_id, before, counters in drift if before is None]
+        changed = [dict(user_id=user_id, **counters) for user_id, before, counters in drift if before is not None]
+        if missing:
+            db.session.execute(insert(UserStats), missing)
+        if changed:
+            db.session.execute(update(UserStats), changed)
+        db.session.commit()
+    return drift
+
+
+def day_of(column):
+    # SQLite has no DATE type and CAST(... AS DATE) yields a number there.
+    if db.session.get_bind().dialect.name == "sqlite":
+        return func.date(column)
+    return cast(column, Date)
+
+
+def _daily_counts(stmt):
+    return {str(day): count for day, count in db.session.execute(stmt)}
+
+
+def get_daily_counts(user_id, start_date):
+    """Return ``(moods, todos_done, habit_entries)`` per-day counts since ``start_date``.
+
+    Each value is a ``{"YYYY-MM-DD": count}`` dict built from ``GROUP BY`` rows,
+    so only one tuple per active day leaves the database.
+    """
+    since = datetime.combine(start_date, datetime.min.time())
+
+    mood_day = day_of(Mood.created_at)
+    moods = _daily_counts(
+        select(mood_day, func.count())
+        .where(Mood.user_id == user_id, Mood.created_at >= since)
+        .group_by(mood_day)
+    )
+
+    todo_day = day_of(ToDo.created_at)
+    todos_done = _daily_counts(
+        select(todo_day, func.count())
+        .where(ToDo.user_id == user_id, ToDo.done.is_(True), ToDo.created_at >= since)
+        .group_by(todo_day)
+    )
+
+    habit_entries = _daily_counts(
+        select(HabitEntry.date, func.count())
+        .join(Habit, Habit.id == HabitEntry.habit_id)
+        .where(Habit.user_id == user_id, HabitEntry.date >= start_date)
+        .group_by(HabitEntry.date)
+    )
+    return moods, todos_done, habit_entries
+
+
+def get_global_stats():
+    """Return the admin dashboard totals in a single round trip.
+
+    Activity totals are summed from user_stats (one row per user) instead of
+    counting the activity tables themselves.
+    """
+    def total(counter):
+        return select(func.coalesce(func.sum(counter), 0)).scalar_subquery()
+
+    row = db.session.execute(
+        select(
+            _count(User).label("users"),
+            total(UserStats.moods).label("moods"),
+            total(UserStats.todos).label("tasks"),
+            total(UserStats.habits).label("habits"),
+            _count(Tip).label("tips"),
+        )
+    ).one()
+    return dict(row._mapping)
@@ -0,0 +1,217 @@
+import base64
+import json
+
+from sqlalchemy import event, func, insert, select, text
+
+from extensions import db
+from models import Habit, HabitEntry, Mood, SyncChange, ToDo
+from stats import habit_owner
+
+SYNC_KINDS = {
+    "moods": Mood,
+    "todos": ToDo,
+    "habits": Habit,
+    "habit_entries": HabitEntry,
+}
+_KIND_BY_MODEL = {model: kind for kind, model in SYNC_KINDS.items()}
+
+
+# First key of the Postgres advisory locks that order each user's log writes.
+SYNC_LOCK_NAMESPACE = 7_303_012
+
+
+def lock_change_log(connection, user_ids):
+    """Hold the users' change-log locks until the transaction ends (Postgres only).
+
+    Log ids are handed out at insert time but become visible at commit, so
+    two transactions writing for the same user could commit out of order and
+    a client syncing in between would skip the lower id for good. Taking the
+    lock before inserting makes each user's ids become visible in order.
+    SQLite has a single writer, which already guarantees this.
+    """
+    if connection.dialect.name != "postgresql":
+        return
+    for user_id in sorted(set(user_ids)):
+        connection.execute(
+            text("SELECT pg_advisory_xact_lock(CAST(:namespace AS INTEGER), CAST(:user_id AS INTEGER))"),
+            {"namespace": SYNC_LOCK_NAMESPACE, "user_id": user_id},
+        )
+
+
+def record_changes(connection, user_id, kind, row_ids, op):
+    """Append change-log rows for writes that bypass the ORM session hooks."""
+    if row_ids:
+        lock_change_log(connection, [user_id])
+        connection.execute(
+            insert(SyncChange),
+            [{"user_id": user_id, "kind": kind, "row_id": row_id, "op": op} for row_id in row_ids],
+        )
+
+
+@event.listens_for(db.session, "before_flush")
+def _collect_changes(session, flush_context, instances):
+    pending = session.info["sync_changes"] = []
+
+    def collect(obj, op):
+        kind = _KIND_BY_MODEL.get(type(obj))
+        if kind is not None:
+            user_id = habit_owner(session, obj) if kind == "habit_entries" else obj.user_id
+            pending.append((user_id, kind, obj, op))
+
+    with session.no_autoflush:
+        for obj in session.new:
+            collect(obj, "upsert")
+        for obj in session.dirty:
+            if session.is_modified(obj):
+                collect(obj, "upsert")
+        for obj in session.deleted:
+            collect(obj, "delete")
+
+
+@event.listens_for(db.session, "after_flush")
+def _write_changes(session, flush_context):
+    pending = session.info.pop("sync_changes", None)
+    if not pending:
+        return
+    rows = [
+        {"user_id": user_id, "kind": kind, "row_id": obj.id, "op": op}
+        for user_id, kind, obj, op in pending
+        if user_id is not None
+    ]
+    if rows:
+        connection = session.connection()
+        lock_change_log(connection, [row["user_id"] for row in rows])
+        connection.execute(insert(SyncChange), rows)
+
+
+class CursorExpired(Exception):
+    """The change log no longer reaches back to the cursor; the client must sync in full."""
+
+
+def log_start():
+    """The oldest change-log id still kept, or None while the log is empty."""
+    return db.session.scalar(select(func.min(SyncChange.id)))
+
+
+def _owned(model, user_id):
+    query = model.query
+    if model is HabitEntry:
+        return query.join(Habit).filter(Habit.user_id == user_id)
+    return query.filter(model.user_id == user_id)
+
+
+def _encode_position(head, kind_index, after):
+    payload = json.dumps([head, kind_index, after])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def _decode_position(token):
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != 3:
+        return None
+    if not all(type(value) is int and value >= 0 for value in values) or values[1] > len(SYNC_KINDS):
+        return None
+    return tuple(values)
+
+
+def _delta_cursor(seq):
+    # 0 asks for a full sync, so a delta from the very start of an empty log
+    # is sent as a finished full-sync position instead.
+    return seq if seq else _encode_position(0, len(SYNC_KINDS), 0)
+
+
+def sync_page(user_id, cursor, limit):
+    """Return ``(changes, next_cursor, has_more)`` for a ``/sync`` request.
+
+    ``cursor`` is 0 to start a full sync, a change-log id for a delta sync,
+    or an opaque position in a running full sync. Raises ``ValueError`` for
+    anything else and :class:`CursorExpired` for ids pruned from the log.
+    """
+    cursor = str(cursor)
+    if cursor.isdigit():
+        if int(cursor):
+            start = log_start()
+            # Cleanup keeps the newest pruned row, so ids up to it are gone
+            # only when the cursor is older than the row before it.
+            if start is not None and int(cursor) + 1 < start:
+                raise CursorExpired(cursor)
+            return changes_since(user_id, int(cursor), limit)
+        return full_sync(user_id, limit)
+    position = _decode_position(cursor)
+    if position is None:
+        raise ValueError(f"Invalid sync cursor {cursor!r}")
+    head, kind_index, _after = position
+    if kind_index == len(SYNC_KINDS):
+        return changes_since(user_id, head, limit)
+    return full_sync(user_id, limit, position)
+
+
+def full_sync(user_id, limit, position=None):
+    """Return ``(changes, next_cursor, has_more)`` for one page of a full sync.
+
+    Every current row of the user is sent as an upsert, kind by kind in id
+    order, read from the tables themselves: the change log may not reach
+    back far enough. The first page notes where the log stands; while pages
+    remain the cursor is an opaque string, and the last page returns that
+    log position, so the next delta sync picks up what changed meanwhile.
+    """
+    if position is None:
+        # Under the user's lock no write of theirs is in flight, so every log
+        # id up to the head is either visible in the tables read next or not
+        # the user's.
+        lock_change_log(db.session.connection(), [user_id])
+        position = (db.session.scalar(select(func.max(SyncChange.id))) or 0, 0, 0)
+    head, kind_index, after = position
+    changes = {kind: {"upserts": [], "deletes": []} for kind in SYNC_KINDS}
+    kinds = list(SYNC_KINDS.items())
+    remaining = limit
+    while kind_index < len(kinds):
+        kind, model = kinds[kind_index]
+        rows = _owned(model, user_id).filter(model.id > after).order_by(model.id).limit(remaining + 1).all()
+        if len(rows) > remaining:
+            rows = rows[:remaining]
+            changes[kind]["upserts"] = rows
+            return changes, _encode_position(head, kind_index, rows[-1].id if rows else after), True
+        changes[kind]["upserts"] = rows
+        remaining -= len(rows)
+        kind_index, after = kind_index + 1, 0
+    return changes, _delta_cursor(head), False
+
+
+def changes_since(user_id, cursor, limit):
+    """Return ``(changes, next_cursor, has_more)`` for a user's delta sync.
+
+    ``changes`` maps each kind to ``{"upserts": [rows], "deletes": [ids]}``,
+    collapsing repeated changes to the same row into its final state.
+    """
+    log = db.session.execute(
+        select(SyncChange.id, SyncChange.kind, SyncChange.row_id, SyncChange.op)
+        .where(SyncChange.user_id == user_id, SyncChange.id > cursor)
+        .order_by(SyncChange.id)
+        .limit(limit + 1)
+    ).all()
+    has_more = len(log) > limit
+    log = log[:limit]
+
+    latest = {}
+    for seq, kind, row_id, op in log:
+        latest[(kind, row_id)] = op
+
+    changes = {kind: {"upserts": [], "deletes": []} for kind in SYNC_KINDS}
+    for kind, model in SYNC_KINDS.items():
+        ids = [row_id for (k, row_id), op in latest.items() if k == kind and op == "upsert"]
+        found = {}
+        if ids:
+            found = {obj.id: obj for obj in _owned(model, user_id).filter(model.id.in_(ids))}
+        changes[kind]["upserts"] = list(found.values())
+        changes[kind]["deletes"] = sorted(
+            row_id for (k, row_id), op in latest.items()
+            if k == kind and (op == "delete" or (op == "upsert" and row_id not in found))
+        )
+
+    next_cursor = log[-1][0] if log else cursor
+    return changes, _delta_cursor(next_cursor), has_more